@@ -9,9 +9,38 @@ Usage:
 
 Options:
 
+	--format <format>
+		Print the results of the list, info, stat and conflicts commands as
+		'text', as a 'json' array or as 'ndjson', one JSON object per line.
+		Results are printed as soon as each one is known, and progress
+		messages are printed on standard error.
+
+	--filter <terms>
+		Close or merge the open pull requests matching the search terms, as
+		with the search command, along with any specified ones.
+
 	-h, --help
 		Display this message.
 
+	--timings
+		Record how long every git command, github request and command takes,
+		and display the most costly ones when done. Set the
+		'git-pull-request.trace-file' git config setting to also save them as a
+		Chrome trace event file.
+
+	--max-age <seconds>
+		Use pull request information retrieved from github less than this many
+		seconds ago instead of asking github again.
+
+	--pack-refs
+		Pack the remaining refs after prune deletes branches, which keeps
+		every git command that reads refs fast when many pull requests have
+		been fetched.
+
+	--offline
+		Never contact github, and answer only from the pull request information
+		stored locally by previous commands.
+
 	-r <repo>, --repo <repo>
 		Use this github repo instead of the 'remote origin' or 'github.repo'
 		git config setting. This can be either a remote name or a full
@@ -30,13 +59,25 @@ Commands:
 	#no command# <pull request ID>
 		Performs a fetch.
 
-	close [<comment>]
-		Closes the current pull request on github and deletes the pull request
-		branch.
+	close [<pull request ID>...] [<comment>]
+		Closes the current pull request, or the specified requests, on github
+		and deletes their local branches. Many pull requests are closed on
+		github concurrently, and their branches are deleted together.
+
+	conflicts
+		Displays which local pull request branches would conflict with master
+		and the conflicting files, without checking anything out. Requires git
+		2.38 or newer.
 
 	continue-update, cu
 		Continues the current update after conflicts have been fixed.
 
+	daemon
+		Keeps running in the foreground, refreshing the open pull requests
+		periodically and answering the list, open, search and stat commands
+		run in this repository over a local socket, so they skip starting up
+		and asking github. Commands run directly when no daemon is running.
+
 	fetch <pull request ID>
 		Fetches the pull request into a local branch, optionally updating it
 		and checking it out.
@@ -51,18 +92,39 @@ Commands:
 		Displays a list of all the user's github repositories and the number
 		of pull requests open on each.
 
-	merge
-		Merges the current pull request branch into master and deletes the
-		branch.
+	merge [<pull request ID>...] [<comment>]
+		Merges the current pull request branch, or the branches of the
+		specified requests in order, into master and deletes the branches.
+		Master is checked out once, and the pull requests are closed on github
+		concurrently when 'git-pull-request.merge-auto-close' is set.
 
 	open [<pull request ID>]
 		Opens either the current pull request or the specified request on
 		github.
 
+	prune
+		Deletes the local branches of pull requests that are no longer open,
+		in a single ref transaction, and displays how much space the refs
+		took up before and after. Branches checked out in any worktree are
+		kept.
+
 	pull
 		Pulls remote changes from the other user's remote branch into the local
 		pull request branch.
 
+	search <term>...
+		Displays the open pull requests matching every term, using an index
+		kept in the local store, so no github request is needed once the pull
+		requests have been listed. A term can be 'author:<login or name>',
+		'key:<JIRA key>' or 'path:<path prefix>' to match the files changed by
+		the fetched pull request branch. Other terms match JIRA keys like
+		ABC-123, or the beginning of words in the title or in the author's
+		name.
+
+	stat [<pull request ID>...]
+		Displays the lines and files changed by the specified pull requests or
+		by every open pull request, in total and for each file extension.
+
 	submit [<pull body>] [<pull title>]
 		Pushes a branch and sends a pull request to the user's reviewer on
 		github.
@@ -71,6 +133,21 @@ Commands:
 		Updates the current pull request or the specified request with the local
 		changes in master, using either a rebase or merge.
 
+	update-all
+		Updates every local pull request branch with the local changes in
+		master. The updates run concurrently, each in its own git worktree, so
+		the current checkout is never touched. Branches with conflicts are left
+		in their worktree to be fixed and completed with 'gitpr
+		continue-update'.
+
+	watch [update|stat]
+		Polls github for changes to the open pull requests every
+		'git-pull-request.watch-interval' seconds until interrupted, and
+		fetches the pull requests that were opened or whose head moved. The
+		fetched branches are then optionally updated from master in a worktree,
+		or their changes displayed. Unchanged pull request lists cost a
+		conditional request that github answers with 304 Not Modified.
+
 Copyright (C) 2011 Connor McKay <connor.mckay@liferay.com>
 
 Original Version Copyright (C) 2011 Andreas Gohr <andi@splitbrain.org>
@@ -94,14 +171,27 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import base64
+import collections
+import contextlib
 import getopt
+import hashlib
 import json
 import os
+import Queue
+import random
 import re
+import sqlite3
+import StringIO
+import subprocess
 import sys
-import urllib
-import urllib2
+import threading
+import time
+import traceback
+
+# The network modules (base64, httplib, socket, urllib and urlparse) and
+# multiprocessing are imported by the functions that use them, as loading them
+# is a noticeable part of the startup time of the commands that do not need
+# them
 # import isodate
 # from datetime import date
 
@@ -128,6 +218,22 @@ options = {
 	# Determines whether fetch will automatically checkout the new branch.
 	'fetch-auto-checkout': False,
 
+	# Sets the number of pull requests fetch-all fetches at the same time.
+	'fetch-jobs': 4,
+
+	# Sets an object filter, such as 'blob:none', to fetch pull request
+	# branches with. The skipped objects are fetched from the fork when a
+	# command needs them, which requires git 2.29 or newer.
+	'fetch-filter': None,
+
+	# Sets the number of pull requests stat computes changes for at the same
+	# time. Defaults to the number of processors.
+	'stat-jobs': None,
+
+	# Sets the number of branches conflicts checks at the same time. Defaults
+	# to the number of processors.
+	'conflicts-jobs': None,
+
 	# Determines whether to automatically update a fetched pull request branch.
 	# Setting this option to true will also cause the new branch to be checked
 	# out.
@@ -145,19 +251,252 @@ options = {
 	# Determines whether to open newly submitted pull requests on github
 	'submit-open-github': True,
 
+	# Sets the number of seconds pull request information kept in the local
+	# store is used instead of asking github again.
+	'store-max-age': 60,
+
+	# Determines whether prune packs the remaining refs after deleting
+	# branches.
+	'prune-pack-refs': False,
+
+	# Sets the number of merge bases and diff statistics remembered in the
+	# local store before the least recently used ones are forgotten.
+	'memo-max-entries': 10000,
+
+	# Determines whether to answer only from the local store and never
+	# contact github.
+	'offline': False,
+
+	# Determines whether to display the most costly git commands and github
+	# requests when done, and how many of them.
+	'timings': False,
+	'timings-top': 10,
+
+	# Sets a file to save the timings of every git command and github request
+	# to, in the Chrome trace event format.
+	'trace-file': None,
+
+	# Determines whether the list, open, search and stat commands are answered
+	# by the daemon serving the repository when there is one.
+	'daemon': True,
+
+	# Sets the number of seconds between the refreshes of the open pull
+	# requests made by the daemon.
+	'daemon-refresh': 30,
+
+	# Sets the number of seconds to wait for the daemon to start running a
+	# command before running it directly instead.
+	'daemon-timeout': 10,
+
+	# Sets the format results are printed in.
+	# Possible options: 'text', 'json', 'ndjson'
+	'format': 'text',
+
+	# Sets the number of seconds between the polls of watch, and what it does
+	# with the pull requests it fetches.
+	# Possible actions: None, 'update', 'stat'
+	'watch-interval': 60,
+	'watch-action': None,
+
+	# Sets the number of branches update-all updates at the same time.
+	'update-jobs': 4,
+
 	# Sets a directory to be used for performing updates to prevent
 	# excessive rebuilding by IDE's. Warning: This directory will be hard reset
 	# every time an update is performed, so do not do any work other than
 	# conflict merges in the work directory.
-	'work-dir': None
+	'work-dir': None,
+
+	# Determines whether to print a summary of the github API requests made
+	# and how many of them reused an open keep-alive connection.
+	'http-stats': False,
+
+	# Sets the number of seconds to wait for github before giving up on a
+	# request.
+	'http-timeout': 30,
+
+	# Sets the number of times a github request that failed temporarily is
+	# retried, and the number of seconds to wait before the first retry. The
+	# wait doubles with every retry.
+	'http-retries': 4,
+	'http-retry-delay': 1,
+
+	# Sets the number of github API requests made at the same time by
+	# commands that need many of them.
+	'api-jobs': 8,
+
+	# Sets the number of remaining github API requests below which requests
+	# are spread out evenly until the rate limit resets.
+	'rate-limit-reserve': 50,
+
+	# Determines whether github responses are cached on disk and revalidated
+	# with conditional requests, so unchanged data costs a 304 round trip.
+	'http-cache': True,
+
+	# Sets the directory where github responses are cached.
+	'http-cache-dir': '~/.cache/git-pull-request',
+
+	# Sets the number of seconds a cached response may go unused before it is
+	# evicted.
+	'http-cache-max-age': 7 * 24 * 60 * 60,
+
+	# Sets the number of bytes the response cache may use before the least
+	# recently used responses are evicted.
+	'http-cache-max-size': 50 * 1024 * 1024
 }
 
+# Github credentials, which are only looked up when a command contacts github
+auth_string = None
+auth_lock = threading.Lock()
+
+# Idle keep-alive connections to github, keyed by (scheme, host), shared by
+# every API request made during this run
+http_connections = {}
+http_connections_lock = threading.Lock()
+http_stats = {'requests': 0, 'connections': 0, 'reused': 0, 'not-modified': 0, 'retried': 0, 'throttled': 0}
+
+# The github API rate limit as last reported by github
+rate_limit = {'remaining': None, 'reset': None}
+
+# Whether the response cache has been pruned during this run
+http_cache_pruned = False
+
+# Connection to the local pull request store, opened when first needed
+store = None
+store_lock = threading.RLock()
+
+# Settings read from git config, repository facts remembered for the rest of
+# the run, and long lived git cat-file processes used to look up objects,
+# keyed by working directory
+git_config = {}
+git_facts = {}
+git_facts_lock = threading.Lock()
+git_object_lookups = {}
+git_object_lookups_lock = threading.Lock()
+
+# Worktrees of the update-all pool handed out during this run
+update_worktrees_in_use = set()
+update_worktrees_lock = threading.Lock()
+
+# Whether this process is the daemon answering commands, and the lock that
+# lets it run one command or refresh at a time
+daemon_serving = False
+daemon_lock = threading.Lock()
+
+# Timings of the git commands, github requests and commands run so far
+timings = []
+timings_lock = threading.Lock()
+
+# Where results are printed, which is the original standard output even when
+# messages are redirected to standard error for machine readable formats
+data_output = sys.stdout
+data_records = 0
+
+store_schema = [
+	"""CREATE TABLE IF NOT EXISTS pull_requests (
+		repo_name TEXT NOT NULL,
+		number INTEGER NOT NULL,
+		state TEXT NOT NULL,
+		data TEXT,
+		head_sha TEXT,
+		refreshed_at REAL NOT NULL,
+		fetched_at REAL,
+		original_commits TEXT,
+		PRIMARY KEY (repo_name, number)
+	)""",
+	"""CREATE INDEX IF NOT EXISTS pull_requests_state
+		ON pull_requests (repo_name, state)""",
+	"""CREATE TABLE IF NOT EXISTS pull_request_lists (
+		repo_name TEXT PRIMARY KEY,
+		refreshed_at REAL NOT NULL
+	)""",
+	"""CREATE TABLE IF NOT EXISTS memos (
+		kind TEXT NOT NULL,
+		base_sha TEXT NOT NULL,
+		head_sha TEXT NOT NULL,
+		value TEXT NOT NULL,
+		used_at REAL NOT NULL,
+		PRIMARY KEY (kind, base_sha, head_sha)
+	)""",
+	"""CREATE INDEX IF NOT EXISTS memos_used_at
+		ON memos (used_at)""",
+	"""CREATE TABLE IF NOT EXISTS search_terms (
+		repo_name TEXT NOT NULL,
+		kind TEXT NOT NULL,
+		term TEXT NOT NULL,
+		number INTEGER NOT NULL,
+		PRIMARY KEY (repo_name, number, kind, term)
+	)""",
+	"""CREATE INDEX IF NOT EXISTS search_terms_term
+		ON search_terms (repo_name, kind, term, number)""",
+	"""CREATE TABLE IF NOT EXISTS search_paths (
+		repo_name TEXT NOT NULL,
+		number INTEGER NOT NULL,
+		head_sha TEXT NOT NULL,
+		PRIMARY KEY (repo_name, number)
+	)"""
+]
+
 #print json.dumps(data,sort_keys=True, indent=4)
 
-def authorize_request(req):
-	"""Add the Authorize header to the request"""
+def add_diff_stat(diff_stats, record):
+	"""Adds a file from the output of git diff --numstat -z to the totals"""
+
+	added, deleted, path = record.split('\t', 2)
+
+	# Binary files are listed with '-' instead of line counts
+	added = int(added) if added != '-' else 0
+	deleted = int(deleted) if deleted != '-' else 0
+
+	# Paths are bytes in whatever encoding they were committed with
+	path = path.decode('utf-8', 'replace')
+
+	extension = os.path.splitext(os.path.basename(path))[1][1:]
+	extension_stats = diff_stats['extensions'].get(extension)
+
+	if extension_stats is None:
+		extension_stats = {'files': 0, 'added': 0, 'deleted': 0}
+		diff_stats['extensions'][extension] = extension_stats
+
+	for stats in (diff_stats, extension_stats):
+		stats['files'] += 1
+		stats['added'] += added
+		stats['deleted'] += deleted
+
+def add_update_worktree():
+	"""Returns the path of a worktree from the pool used by update-all that
+	is free to be used, creating a new one if needed
+
+	A worktree is free when its HEAD is detached. Worktrees left on a branch
+	hold conflicts that have not been resolved yet."""
+
+	with update_worktrees_lock:
+		worktrees_path = get_update_worktrees_path()
+		index = 0
+
+		while True:
+			worktree_path = os.path.join(worktrees_path, str(index))
+			index += 1
 
-	req.add_header("Authorization", "Basic %s" % auth_string)
+			if worktree_path in update_worktrees_in_use:
+				continue
+
+			if not os.path.exists(worktree_path):
+				ret, output = run_command('git worktree add -q --detach "%s" master' % worktree_path)
+				if ret != 0:
+					raise UserWarning("Could not create the update worktree %s\n%s" % (worktree_path, output))
+			else:
+				ret, output = run_command('git symbolic-ref -q HEAD', worktree_path)
+				if ret == 0:
+					continue
+
+			update_worktrees_in_use.add(worktree_path)
+			return worktree_path
+
+def authorize_request(headers):
+	"""Add the Authorize header to the request headers"""
+
+	headers['Authorization'] = "Basic %s" % get_auth_string()
 
 def build_branch_name(pull_request):
 	"""Returns the local branch name that a pull request should be fetched into"""
@@ -174,6 +513,50 @@ def build_branch_name(pull_request):
 
 	return branch_name
 
+def build_fetch_command(repo_url, refspecs):
+	"""Returns the git command that fetches the refspecs from the repository,
+	applying the fetch filter"""
+
+	fetch_filter = ''
+
+	if options['fetch-filter']:
+		fetch_filter = '--filter=%s ' % options['fetch-filter']
+
+	return 'git fetch %s%s %s' % (fetch_filter, repo_url, ' '.join(refspecs))
+
+def build_output_capture(isatty):
+	"""Returns a stream collecting the output of a command answered by the
+	daemon as UTF-8, since commands print both unicode and byte strings"""
+
+	stream = StringIO.StringIO()
+	write = stream.write
+
+	stream.write = lambda text: write(text.encode('utf-8') if isinstance(text, unicode) else text)
+	stream.isatty = lambda: isatty
+
+	return stream
+
+def build_pull_request_record(pull_request):
+	"""Returns the information about a pull request printed by list in the
+	machine readable formats"""
+
+	head = pull_request.get('head') or {}
+	base = pull_request.get('base') or {}
+
+	return {
+		'number': pull_request.get('number'),
+		'title': pull_request.get('title'),
+		'body': pull_request.get('body'),
+		'url': pull_request.get('html_url'),
+		'user': pull_request['user'].get('login'),
+		'user_name': pull_request['user'].get('name'),
+		'branch': head.get('ref'),
+		'head': head.get('sha'),
+		'base': base.get('ref'),
+		'created_at': pull_request.get('created_at'),
+		'updated_at': pull_request.get('updated_at')
+	}
+
 def build_pull_request_title(branch_name):
 	"""Returns the default title to use for a pull request for the branch with
 	the name"""
@@ -194,17 +577,13 @@ def close_pull_request(repo_name, pull_request_ID, comment = None):
 	if comment is None:
 		comment = options['close-default-comment']
 
-	try:
-		f = open('/tmp/git-pull-request-treeish-%s' % pull_request_ID, 'rb')
-		branch_treeish = f.read()
-		f.close()
+	branch_treeish = get_original_commits(repo_name, pull_request_ID)
 
+	if branch_treeish is not None:
 		if comment is None:
 			comment = ''
 
 		comment += "\n\nOriginal commits: %s" % branch_treeish
-	except IOError:
-		pass
 
 	if comment is not None and comment != '':
 		post_comment(repo_name, pull_request_ID, comment)
@@ -212,6 +591,56 @@ def close_pull_request(repo_name, pull_request_ID, comment = None):
 	url = "http://github.com/api/v2/json/issues/close/%s/%s" % (repo_name, pull_request_ID)
 	github_json_request(url)
 
+	save_pull_request_state(repo_name, pull_request_ID, 'closed')
+
+def close_pull_requests(repo_name, pull_request_IDs, comment = None):
+	"""Closes the pull requests on github concurrently, displaying each one as
+	it is closed, and returns the set of IDs closed along with the errors for
+	the others"""
+
+	def close(pull_request_ID):
+		try:
+			pull_request = get_pull_request(repo_name, pull_request_ID)
+			close_pull_request(repo_name, pull_request_ID, comment)
+		except UserWarning, e:
+			return pull_request_ID, None, e
+
+		return pull_request_ID, pull_request, None
+
+	closed_IDs = set()
+	errors = []
+
+	for pull_request_ID, pull_request, error in github_json_requests(close, pull_request_IDs):
+		if error is not None:
+			print color_text("Could not close pull request %s: %s" % (pull_request_ID, error), 'error')
+			errors.append(error)
+			continue
+
+		display_pull_request_minimal(pull_request)
+		closed_IDs.add(pull_request_ID)
+
+	return closed_IDs, errors
+
+def close_git_object_lookups():
+	"""Ends the long lived git cat-file processes"""
+
+	with git_object_lookups_lock:
+		for process in git_object_lookups.values():
+			process.stdin.close()
+			process.wait()
+
+		git_object_lookups.clear()
+
+def close_http_connections():
+	"""Closes all idle keep-alive connections"""
+
+	with http_connections_lock:
+		for idle in http_connections.values():
+			for conn in idle:
+				conn.close()
+
+		http_connections.clear()
+
 def color_text(text, token, bold = False):
 	"""Return the given text in ANSI colors"""
 
@@ -235,6 +664,86 @@ def color_text(text, token, bold = False):
 	else:
 		return text
 
+def command_daemon(repo_name):
+	"""Serves the list, open, search and stat commands of the repository from
+	this process until interrupted
+
+	The open pull requests are refreshed every daemon-refresh seconds with
+	conditional requests, and the store, the keep-alive connections to github
+	and the repository facts stay warm between commands."""
+
+	import fcntl
+	import signal
+	import socket
+
+	global daemon_serving
+
+	path = get_daemon_socket_path()
+
+	if os.path.exists(path):
+		client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+		try:
+			client.connect(path)
+		except socket.error:
+			# Left behind by a daemon that did not exit cleanly
+			os.remove(path)
+		else:
+			raise UserWarning("A daemon is already serving this repository on %s" % path)
+		finally:
+			client.close()
+
+	# Ask for any missing credentials now rather than while answering
+	get_auth_string()
+
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+	# The git processes started while answering must not inherit the sockets,
+	# or clients would wait for them to exit before seeing the end of the
+	# answer
+	fcntl.fcntl(server, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+	try:
+		server.bind(path)
+	except socket.error, e:
+		raise UserWarning("Could not listen on %s\n%s" % (path, e))
+
+	os.chmod(path, 0600)
+	server.listen(16)
+
+	daemon_serving = True
+
+	# Remove the socket when stopped by kill as well
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	refresher = threading.Thread(target = refresh_daemon, args = (repo_name,), name = 'daemon-refresh')
+	refresher.daemon = True
+	refresher.start()
+
+	print color_text("Serving %s on %s" % (repo_name, path), 'status')
+
+	try:
+		while True:
+			connection, address = server.accept()
+			fcntl.fcntl(connection, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+			try:
+				with daemon_lock:
+					serve_daemon_request(connection)
+			except (socket.error, ValueError), e:
+				print color_text("Could not answer a command: %s" % e, 'warning')
+			except Exception:
+				# Keep serving, the client runs the command directly when it gets
+				# no answer
+				traceback.print_exc()
+			finally:
+				connection.close()
+	except KeyboardInterrupt:
+		print color_text("Stopped serving %s" % repo_name, 'status')
+	finally:
+		server.close()
+		os.remove(path)
+
 def command_fetch(repo_name, pull_request_ID, auto_update = False):
 	"""Fetches a pull request into a local branch"""
 
@@ -243,12 +752,12 @@ def command_fetch(repo_name, pull_request_ID, auto_update = False):
 
 	pull_request = get_pull_request(repo_name, pull_request_ID)
 	display_pull_request(pull_request)
-	branch_name = fetch_pull_request(pull_request)
+	branch_name = fetch_pull_request(repo_name, pull_request)
 
 	if auto_update:
-		update_branch(branch_name)
+		update_branch(repo_name, branch_name)
 	elif options['fetch-auto-checkout']:
-		ret = os.system('git checkout %s' % branch_name)
+		ret = system('git checkout %s' % branch_name)
 		if ret != 0:
 			raise UserWarning("Could not checkout %s" % branch_name)
 
@@ -257,32 +766,80 @@ def command_fetch(repo_name, pull_request_ID, auto_update = False):
 	print
 	display_status()
 
-def command_close(repo_name, comment = None):
-	"""Closes the current pull request on github with the optional comment, then
-	deletes the branch."""
+def command_close(repo_name, pull_request_IDs = None, comment = None, search_terms = None):
+	"""Closes the current pull request, or the pull requests with the IDs or
+	matching the search terms, on github with the optional comment, then
+	deletes their local branches."""
+
+	pull_request_IDs = get_selected_pull_request_IDs(repo_name, pull_request_IDs, search_terms)
 
-	print color_text("Closing pull request", 'status')
+	if not pull_request_IDs:
+		pull_request_IDs = [get_pull_request_ID(get_current_branch_name())]
+
+	if len(pull_request_IDs) == 1:
+		print color_text("Closing pull request", 'status')
+	else:
+		print color_text("Closing %s pull requests" % len(pull_request_IDs), 'status')
 	print
 
-	branch_name = get_current_branch_name()
-	pull_request_ID = get_pull_request_ID(branch_name)
-	pull_request = get_pull_request(repo_name, pull_request_ID)
+	closed_IDs, errors = close_pull_requests(repo_name, pull_request_IDs, comment)
 
-	display_pull_request(pull_request)
+	local_heads = get_pull_request_branch_heads()
+	delete_branches([branch_name for branch_name in sorted(local_heads) if get_pull_request_ID(branch_name) in closed_IDs])
 
-	close_pull_request(repo_name, pull_request_ID, comment)
+	if errors:
+		raise UserWarning("Could not close %s of %s pull requests" % (len(errors), len(pull_request_IDs)))
 
-	ret = os.system('git checkout master')
-	if ret != 0:
-		raise UserWarning("Could not checkout master")
+	print
+	if len(closed_IDs) == 1:
+		print color_text("Pull request closed", 'success')
+	else:
+		print color_text("%s pull requests closed" % len(closed_IDs), 'success')
+	print
+	display_status()
 
-	print color_text("Deleting branch %s" % branch_name, 'status')
-	ret = os.system('git branch -D %s' % branch_name)
-	if ret != 0:
-		raise UserWarning("Could not delete branch")
+def command_conflicts():
+	"""Displays which local pull request branches would conflict with master,
+	using in-memory merges that never touch a worktree"""
+
+	print color_text("Checking pull request branches for conflicts with master", 'status')
+	print
+
+	master_sha = get_commit_shas('master')[0]
+	local_heads = get_pull_request_branch_heads()
+	branch_names = sorted(local_heads, key = get_pull_request_ID)
+
+	def check(branch_name):
+		return branch_name, get_merge_conflicts(master_sha, local_heads[branch_name])
+
+	jobs = options['conflicts-jobs'] or get_cpu_count()
+	conflicting = 0
+
+	for branch_name, conflicts in run_jobs(check, branch_names, int(jobs)):
+		if conflicts:
+			conflicting += 1
+
+		if options['format'] != 'text':
+			display_record({
+				'number': get_pull_request_ID(branch_name),
+				'branch': branch_name,
+				'head': local_heads[branch_name],
+				'conflicts': conflicts
+			})
+			continue
+
+		if conflicts:
+			print "%s: %s" % (branch_name, color_text("%s conflicting files" % len(conflicts), 'warning'))
+
+			for path in conflicts:
+				print "	%s" % path
+		else:
+			print "%s: %s" % (branch_name, color_text("merges cleanly", 'success'))
+
+	finish_records()
 
 	print
-	print color_text("Pull request closed", 'success')
+	print color_text("%s of %s pull request branches conflict with master" % (conflicting, len(branch_names)), 'status')
 	print
 	display_status()
 
@@ -299,10 +856,28 @@ def command_fetch_all(repo_name):
 	print color_text("Fetching all pull requests", 'status')
 	print
 
-	pull_requests = get_pull_requests(repo_name)
-	for pull_request in pull_requests:
-		fetch_pull_request(pull_request)
+	count = 0
+	failures = []
+
+	for pull_request, output, error, up_to_date in fetch_pull_requests(repo_name, get_pull_request_pages(repo_name)):
+		count += 1
 		display_pull_request_minimal(pull_request)
+
+		if output:
+			print output.rstrip()
+
+		if error is not None:
+			print color_text(error, 'error')
+			failures.append((pull_request, error))
+
+		print
+
+	if failures:
+		print color_text("Failed to fetch %s of %s pull requests:" % (len(failures), count), 'error')
+
+		for pull_request, error in failures:
+			print "  REQUEST %s: %s" % (pull_request.get('number'), error)
+
 		print
 
 	display_status()
@@ -318,50 +893,92 @@ def command_info(username):
 	data = github_json_request(url)
 	repos = data['repositories']
 	# print json.dumps(data,sort_keys=True, indent=4)
-	total = 0
-	issue_list = {}
-	for pull_request_info in repos:
-		issue_count = pull_request_info['open_issues']
 
-		if issue_count > 0:
+	# Only repositories with open issues can have open pull requests
+	repos = [pull_request_info for pull_request_info in repos if pull_request_info['open_issues'] > 0]
+
+	def count_pull_requests(pull_request_info):
+		repo_name = "%s/%s" % (pull_request_info['owner'], pull_request_info['name'])
+		pull_request_count = sum(len(pull_requests) for pull_requests in get_pull_request_pages(repo_name))
+
+		return pull_request_info, pull_request_count
+
+	total = 0
+	for pull_request_info, pull_request_count in github_json_requests(count_pull_requests, repos):
+		if pull_request_count > 0 and options['format'] != 'text':
+			display_record({
+				'repo': "%s/%s" % (pull_request_info['owner'], pull_request_info['name']),
+				'name': pull_request_info['name'],
+				'open_pull_requests': pull_request_count
+			})
+
+			total += pull_request_count
+		elif pull_request_count > 0:
 			base_name = pull_request_info['name']
-			repo_name = "%s/%s" % (pull_request_info['owner'], base_name)
 
-			print "  %s: %s" % (color_text(base_name, 'display-info-repo-title'), color_text(issue_count, 'display-info-repo-count'))
+			print "  %s: %s" % (color_text(base_name, 'display-info-repo-title'), color_text(pull_request_count, 'display-info-repo-count'))
+
+			total += pull_request_count
 
-			total += issue_count
+	finish_records()
 
 	print "-"
 	print "%s: %s" % (color_text("Total pull requests", 'display-info-total-title', True), color_text(total, 'display-info-total-count', True))
 	print
 	display_status()
 
-def command_merge(repo_name, comment = None):
-	"""Merges changes from the local pull request branch into master and deletes
-	the pull request branch"""
+def command_merge(repo_name, pull_request_IDs = None, comment = None, search_terms = None):
+	"""Merges changes from the local pull request branch, or the branches of the
+	pull requests with the IDs or matching the search terms, into master and
+	deletes the pull request branches
 
-	branch_name = get_current_branch_name()
-	pull_request_ID = get_pull_request_ID(branch_name)
+	Master is checked out once and the branches are merged in order. When a
+	merge fails, the branches merged before it are still deleted and closed."""
+
+	pull_request_IDs = get_selected_pull_request_IDs(repo_name, pull_request_IDs, search_terms)
+
+	if pull_request_IDs:
+		branch_names_by_ID = dict((get_pull_request_ID(branch_name), branch_name) for branch_name in get_pull_request_branch_heads())
+		missing_IDs = [pull_request_ID for pull_request_ID in pull_request_IDs if pull_request_ID not in branch_names_by_ID]
+
+		if missing_IDs:
+			raise UserWarning("No local branch for pull requests %s, fetch them first" % ', '.join(str(pull_request_ID) for pull_request_ID in missing_IDs))
+
+		branch_names = [branch_names_by_ID[pull_request_ID] for pull_request_ID in pull_request_IDs]
+	else:
+		branch_names = [get_current_branch_name()]
 
-	print color_text("Merging %s into master" % branch_name, 'status')
+	print color_text("Merging %s into master" % ', '.join(branch_names), 'status')
 	print
 
-	ret = os.system('git checkout master')
+	ret = system('git checkout master')
 	if ret != 0:
 		raise UserWarning("Could not checkout master")
 
-	ret = os.system('git merge %s' % branch_name)
-	if ret != 0:
-		raise UserWarning("Merge with master failed. Resolve conflicts, switch back into the pull request branch, and merge again")
+	merged_branch_names = []
+	failed_branch_name = None
 
-	print color_text("Deleting branch %s" % branch_name, 'status')
-	ret = os.system('git branch -D %s' % branch_name)
-	if ret != 0:
-		raise UserWarning("Could not delete branch")
+	for branch_name in branch_names:
+		ret = system('git merge %s' % branch_name)
+		if ret != 0:
+			failed_branch_name = branch_name
+			break
 
-	if options['merge-auto-close']:
-		print color_text("Closing pull request", 'status')
-		close_pull_request(repo_name, pull_request_ID, comment)
+		merged_branch_names.append(branch_name)
+
+	delete_branches(merged_branch_names)
+
+	errors = []
+
+	if options['merge-auto-close'] and merged_branch_names:
+		print color_text("Closing pull requests", 'status')
+		closed_IDs, errors = close_pull_requests(repo_name, [get_pull_request_ID(branch_name) for branch_name in merged_branch_names], comment)
+
+	if failed_branch_name is not None:
+		raise UserWarning("Merge of %s with master failed. Resolve conflicts, switch back into the pull request branch, and merge again" % failed_branch_name)
+
+	if errors:
+		raise UserWarning("Merged, but could not close %s of %s pull requests" % (len(errors), len(merged_branch_names)))
 
 	print
 	print color_text("Merge completed", 'success')
@@ -379,6 +996,28 @@ def command_open(repo_name, pull_request_ID = None):
 
 	open_URL(pull_request.get('html_url'))
 
+def command_search(repo_name, terms):
+	"""Displays the open pull requests matching every search term"""
+
+	if not terms:
+		raise UserWarning("Please specify what to search for")
+
+	count = 0
+
+	for pull_request in search_pull_requests(repo_name, terms):
+		if options['format'] != 'text':
+			display_record(build_pull_request_record(pull_request))
+		else:
+			display_pull_request_minimal(pull_request)
+			print "	%s" % color_text(pull_request.get('html_url'), 'display-title-url')
+
+		count += 1
+
+	finish_records()
+
+	print
+	print color_text("%s matching open pull requests" % count, 'status')
+
 def command_show(repo_name):
 	"""List open pull requests
 
@@ -388,13 +1027,20 @@ def command_show(repo_name):
 	print color_text("Loading open pull requests for %s" % repo_name, 'status')
 	print
 
-	pull_requests = get_pull_requests(repo_name)
+	count = 0
 
-	if len(pull_requests) == 0:
-		print "No open pull requests found"
+	for pull_request in get_pull_requests(repo_name):
+		if options['format'] != 'text':
+			display_record(build_pull_request_record(pull_request))
+		else:
+			display_pull_request(pull_request)
+
+		count += 1
+
+	finish_records()
 
-	for pull_request in pull_requests:
-		display_pull_request(pull_request)
+	if count == 0:
+		print "No open pull requests found"
 
 	display_status()
 
@@ -403,31 +1049,131 @@ def get_pr_stats(repo_name, pull_request_ID):
 		is_int = False
 		try:
 			pull_request_ID = int(pull_request_ID)
-			pull_request = get_pull_request(repo_name, pull_request_ID)
-		except Exception, e:
+		except TypeError:
+			# Already retrieved
 			pull_request = pull_request_ID
+		except ValueError:
+			raise UserWarning("Invalid pull request ID: %s" % pull_request_ID)
+		else:
+			pull_request = get_pull_request(repo_name, pull_request_ID)
 
 		display_pull_request_minimal(pull_request)
 
 		branch_name = build_branch_name(pull_request)
-		ret = os.system('git show-ref --verify -q refs/heads/%s' % branch_name)
-
-		if ret != 0:
-			branch_name = fetch_pull_request(pull_request)
-
-			ret = os.system('git show-ref --verify -q refs/heads/%s' % branch_name)
+		if not ref_exists('refs/heads/%s' % branch_name):
+			branch_name = fetch_pull_request(repo_name, pull_request)
 
-			if  ret != 0:
+			if not ref_exists('refs/heads/%s' % branch_name):
 				raise UserWarning("Fetch failed")
 
-		merge_base = os.popen('git merge-base master %s' % branch_name).read().strip()
-		ret = os.system("git --no-pager diff --shortstat {0}..{1} && git diff --numstat --pretty='%H' --no-renames {0}..{1} | xargs -0n1 echo -n | awk '{{print $3}}' | sed -e 's/^.*\.\(.*\)$/\\1/' | sort | uniq -c | tr '\n' ',' | sed 's/,$//'".format(merge_base, branch_name))
-		print
+		branch_name, merge_base, diff_stats = get_pull_request_stats(pull_request)
+
+		display_diff_stats(pull_request, branch_name, merge_base, diff_stats)
 	else:
-		pull_requests = get_pull_requests(repo_name)
+		get_all_pr_stats(repo_name)
 
-		for pull_request in pull_requests:
-			get_pr_stats(repo_name, pull_request)
+def get_all_pr_stats(repo_name):
+	"""Displays the changes made by every open pull request, followed by the
+	totals for each pull request and file extension
+
+	The missing branches of each page of pull requests are fetched together,
+	then the changes of the pull requests are computed concurrently and
+	displayed in order, while the next pages are retrieved."""
+
+	local_heads = get_pull_request_branch_heads()
+
+	def pull_requests():
+		# Fetch the missing branches of each page together, and pass on any
+		# fetch error with the pull request
+		for page in get_pull_request_pages(repo_name):
+			missing_pull_requests = [pull_request for pull_request in page if build_branch_name(pull_request) not in local_heads]
+			errors = {}
+
+			if missing_pull_requests:
+				for pull_request, output, error, up_to_date in fetch_pull_requests(repo_name, [missing_pull_requests]):
+					if error is not None:
+						errors[pull_request['number']] = error
+
+			for pull_request in page:
+				yield pull_request, errors.get(pull_request['number'])
+
+	def compute(item):
+		pull_request, error = item
+
+		if error is not None:
+			return pull_request, None, error
+
+		try:
+			return pull_request, get_pull_request_stats(pull_request), None
+		except UserWarning, e:
+			return pull_request, None, e
+
+	jobs = options['stat-jobs'] or get_cpu_count()
+
+	totals = []
+	extension_totals = {}
+
+	for pull_request, stats, error in run_jobs(compute, pull_requests(), int(jobs)):
+		display_pull_request_minimal(pull_request)
+
+		if error is not None:
+			display_stats_error(pull_request, error)
+			continue
+
+		branch_name, merge_base, diff_stats = stats
+		display_diff_stats(pull_request, branch_name, merge_base, diff_stats)
+
+		totals.append((pull_request, diff_stats))
+
+		for extension, extension_stats in diff_stats['extensions'].items():
+			extension_total = extension_totals.setdefault(extension, {'files': 0, 'added': 0, 'deleted': 0})
+
+			for key in ('files', 'added', 'deleted'):
+				extension_total[key] += extension_stats[key]
+
+	if options['format'] != 'text' or not totals:
+		return
+
+	print color_text("Lines changed per pull request", 'status')
+
+	for pull_request, diff_stats in sorted(totals, key = lambda total: -(total[1]['added'] + total[1]['deleted'])):
+		print "  REQUEST %s: %s files, +%s -%s" % (pull_request.get('number'), diff_stats['files'], diff_stats['added'], diff_stats['deleted'])
+
+	print
+	print color_text("Lines changed per file extension", 'status')
+
+	for extension, extension_total in sorted(extension_totals.items(), key = lambda item: -(item[1]['added'] + item[1]['deleted'])):
+		print "  %s: %s files, +%s -%s" % (extension or '(none)', extension_total['files'], extension_total['added'], extension_total['deleted'])
+
+	print
+
+def command_stat(repo_name, pull_request_IDs = None):
+	"""Displays the changes made by the pull requests or by all open pull
+	requests"""
+
+	if not pull_request_IDs:
+		get_pr_stats(repo_name, None)
+		finish_records()
+		return
+
+	errors = 0
+
+	for pull_request_ID, pull_request, error in get_pull_requests_by_ID(repo_name, pull_request_IDs):
+		if error is None:
+			try:
+				get_pr_stats(repo_name, pull_request)
+			except UserWarning, e:
+				error = e
+
+		if error is not None:
+			display_stats_error(pull_request or pull_request_ID, error)
+			errors += 1
+
+	# Always end the machine readable results, even when some failed
+	finish_records()
+
+	if errors:
+		raise UserWarning("Could not display the changes of %s of %s pull requests" % (errors, len(pull_request_IDs)))
 
 def command_submit(repo_name, username, reviewer_repo_name = None, pull_body = None, pull_title = None, submitOpenGitHub = True):
 	"""Push the current branch and create a pull request to your github reviewer
@@ -448,7 +1194,7 @@ def command_submit(repo_name, username, reviewer_repo_name = None, pull_body = N
 
 	print color_text("Pushing local branch %s to origin" % branch_name, 'status')
 
-	ret = os.system('git push origin %s' % branch_name)
+	ret = system('git push origin %s' % branch_name)
 
 	if ret != 0:
 		raise UserWarning("Could not push this branch to your origin")
@@ -491,6 +1237,89 @@ def command_submit(repo_name, username, reviewer_repo_name = None, pull_body = N
 	if submitOpenGitHub:
 		open_URL(pull_request.get('html_url'))
 
+def command_update_all(repo_name):
+	"""Updates every local pull request branch from master concurrently, each
+	in a worktree from a reusable pool"""
+
+	print color_text("Updating all pull request branches from master", 'status')
+	print
+
+	if in_work_dir() or in_update_worktree():
+		raise UserWarning("Cannot perform an update from within a work directory.\nIf you are done fixing conflicts run 'gitpr continue-update' to complete the update.")
+
+	current_branch_name = get_current_branch_name(False)
+	checked_out_branches = get_checked_out_branches()
+	local_heads = get_pull_request_branch_heads()
+	branch_names = []
+
+	for branch_name in sorted(local_heads, key = get_pull_request_ID):
+		if branch_name == current_branch_name:
+			print color_text("Skipping %s, which is checked out, use 'gitpr update' instead" % branch_name, 'warning')
+		elif branch_name in checked_out_branches:
+			# Most likely left with conflicts in the pool by an earlier update-all
+			print color_text("Skipping %s, which is checked out in %s" % (branch_name, checked_out_branches[branch_name]), 'warning')
+		else:
+			branch_names.append(branch_name)
+
+	if len(branch_names) < len(local_heads):
+		print
+
+	jobs = max(1, int(options['update-jobs']))
+	worktrees = Queue.Queue()
+
+	for i in range(min(jobs, len(branch_names))):
+		worktrees.put(add_update_worktree())
+
+	def update(branch_name):
+		worktree_path = worktrees.get()
+
+		try:
+			conflicts = update_branch_in_worktree(repo_name, branch_name, worktree_path)
+		except UserWarning, e:
+			worktrees.put(worktree_path)
+			return branch_name, None, e
+
+		if conflicts is None:
+			worktrees.put(worktree_path)
+		else:
+			# The worktree is kept for the conflicts to be fixed in, so
+			# replace it in the pool
+			worktrees.put(add_update_worktree())
+
+		return branch_name, conflicts, None
+
+	conflicting = []
+	failures = []
+
+	for branch_name, conflicts, error in run_jobs(update, branch_names, jobs):
+		if error is not None:
+			print "%s: %s" % (branch_name, color_text(error, 'error'))
+			failures.append(branch_name)
+		elif conflicts is not None:
+			worktree_path, conflicting_files = conflicts
+			print "%s: %s" % (branch_name, color_text("conflicts in %s" % worktree_path, 'warning'))
+
+			for path in conflicting_files:
+				print "	%s" % path
+
+			conflicting.append(branch_name)
+		else:
+			print "%s: %s" % (branch_name, color_text("updated", 'success'))
+
+	print
+
+	if conflicting:
+		print color_text("%s branches have conflicts. Change into their worktree, resolve the conflicts and 'git add' files, then run 'gitpr continue-update'" % len(conflicting), 'warning')
+		print
+
+	if failures:
+		print color_text("%s branches could not be updated" % len(failures), 'error')
+		print
+
+	print color_text("Updated %s of %s branches from master" % (len(branch_names) - len(conflicting) - len(failures), len(branch_names)), 'success')
+	print
+	display_status()
+
 def command_update(repo_name, target = None):
 	if target == None:
 		branch_name = get_current_branch_name()
@@ -504,17 +1333,78 @@ def command_update(repo_name, target = None):
 
 	print color_text("Updating %s from master" % branch_name, 'status')
 
-	update_branch(branch_name)
+	update_branch(repo_name, branch_name)
 	print
 	display_status()
 
-def command_pull(repo_name):
-	"""Pulls changes from the remote branch into the local branch of the pull
-	request"""
+def command_prune(repo_name):
+	"""Deletes the local pull request branches of pull requests that are not
+	open anymore, in a single ref transaction
 
-	branch_name = get_current_branch_name()
+	Fetched pull request branches are otherwise kept forever, and every git
+	command reading refs gets slower as they pile up."""
 
-	print color_text("Pulling remote changes into %s" % branch_name, 'status')
+	print color_text("Pruning the branches of closed pull requests", 'status')
+	print
+
+	open_IDs = set()
+
+	for pull_requests in get_pull_request_pages(repo_name):
+		open_IDs.update(pull_request['number'] for pull_request in pull_requests)
+
+	local_heads = get_pull_request_branch_heads()
+	checked_out_branches = get_checked_out_branches()
+
+	branch_names = []
+
+	for branch_name in sorted(local_heads, key = get_pull_request_ID):
+		if get_pull_request_ID(branch_name) in open_IDs:
+			continue
+
+		if branch_name in checked_out_branches:
+			print color_text("Keeping %s, which is checked out in %s" % (branch_name, checked_out_branches[branch_name]), 'warning')
+			continue
+
+		branch_names.append(branch_name)
+
+	refs_size = get_refs_size()
+
+	if branch_names:
+		delete_refs(dict(('refs/heads/%s' % branch_name, local_heads[branch_name]) for branch_name in branch_names))
+
+	for branch_name in branch_names:
+		if options['format'] != 'text':
+			display_record({
+				'number': get_pull_request_ID(branch_name),
+				'branch': branch_name,
+				'head': local_heads[branch_name]
+			})
+		else:
+			print "Deleted %s (was %s)" % (branch_name, local_heads[branch_name][:7])
+
+	finish_records()
+
+	if options['prune-pack-refs']:
+		print color_text("Packing refs", 'status')
+
+		ret, output = run_command('git pack-refs --all --prune')
+		if ret != 0:
+			raise UserWarning("Could not pack refs\n%s" % output)
+
+	reclaimed = refs_size - get_refs_size()
+
+	print
+	print color_text("Pruned %s of %s pull request branches, reclaiming %s bytes" % (len(branch_names), len(local_heads), reclaimed), 'success')
+	print
+	display_status()
+
+def command_pull(repo_name):
+	"""Pulls changes from the remote branch into the local branch of the pull
+	request"""
+
+	branch_name = get_current_branch_name()
+
+	print color_text("Pulling remote changes into %s" % branch_name, 'status')
 
 	pull_request_ID = get_pull_request_ID(branch_name)
 
@@ -523,7 +1413,7 @@ def command_pull(repo_name):
 
 	print color_text("Pulling from %s (%s)" % (repo_url, pull_request['head']['ref']), 'status')
 
-	ret = os.system('git pull %s %s' % (repo_url, pull_request['head']['ref']))
+	ret = system('git pull %s %s' % (repo_url, pull_request['head']['ref']))
 	if ret != 0:
 		raise UserWarning("Pull failed, resolve conflicts")
 
@@ -532,9 +1422,51 @@ def command_pull(repo_name):
 	print
 	display_status()
 
+def command_watch(repo_name):
+	"""Polls github for changes to the open pull requests until interrupted,
+	fetching the ones that were opened or whose head moved
+
+	Each poll is a conditional request, so the pull request list is only
+	downloaded again when it changed. Failed polls are reported and retried
+	at the next interval."""
+
+	action = options['watch-action']
+
+	if action not in (None, 'update', 'stat'):
+		raise UserWarning("Invalid watch action: %s" % action)
+
+	interval = float(options['watch-interval'])
+
+	print color_text("Watching the open pull requests for %s every %s, press Ctrl-C to stop" % (repo_name, format_age(interval)), 'status')
+	print
+
+	state = {'snapshot': None, 'worktree': None, 'failed': set()}
+
+	try:
+		while True:
+			try:
+				watch_pull_requests(repo_name, action, state)
+			except UserWarning, e:
+				print color_text(e, 'warning')
+
+			time.sleep(interval)
+	except KeyboardInterrupt:
+		print
+		print color_text("Stopped watching", 'status')
+
 def complete_update(branch_name):
-	if in_work_dir():
-		ret = os.system('git checkout master')
+	if in_update_worktree():
+		# Release the branch so the worktree can be reused by update-all
+		ret = system('git checkout -q --detach')
+		if ret != 0:
+			raise UserWarning("Could not release %s from the update worktree" % branch_name)
+
+		original_dir_path = os.path.dirname(get_git_common_dir())
+		print color_text("Switching to original directory", 'status')
+		os.chdir(original_dir_path)
+		chdir(original_dir_path)
+	elif in_work_dir():
+		ret = system('git checkout master')
 		if ret != 0:
 			raise UserWarning("Could not checkout master branch in work directory")
 
@@ -543,11 +1475,11 @@ def complete_update(branch_name):
 		os.chdir(original_dir_path)
 		chdir(original_dir_path)
 		if get_current_branch_name(False) == branch_name:
-			ret = os.system('git reset --hard && git clean -f')
+			ret = system('git reset --hard && git clean -f')
 			if ret != 0:
 				raise UserWarning("Syncing branch %s with work directory failed" % branch_name)
 		else:
-			ret = os.system('git checkout %s' % branch_name)
+			ret = system('git checkout %s' % branch_name)
 			if ret != 0:
 				raise UserWarning("Could not checkout %s" % branch_name)
 
@@ -556,9 +1488,9 @@ def complete_update(branch_name):
 
 def continue_update():
 	if options['update-method'] == 'merge':
-		ret = os.system('git commit')
+		ret = system('git commit')
 	elif options['update-method'] == 'rebase':
-		ret = os.system('git rebase --continue')
+		ret = system('git rebase --continue')
 
 	if ret != 0:
 		raise UserWarning("Updating from master failed\nResolve conflicts and 'git add' files, then run 'gitpr continue-update'")
@@ -568,6 +1500,106 @@ def continue_update():
 
 	complete_update(branch_name)
 
+def delete_refs(refs):
+	"""Deletes the refs, which must still point at the given commits, in a
+	single transaction with git update-ref --stdin, so either all of them are
+	deleted or none are"""
+
+	commands = ''.join('delete %s %s\n' % (ref, sha) for ref, sha in sorted(refs.items()))
+
+	with timed('git', 'git update-ref --stdin (%s deletions)' % len(refs)):
+		process = subprocess.Popen(['git', 'update-ref', '--stdin'], stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+		output = process.communicate(commands)[0]
+
+	if process.returncode != 0:
+		raise UserWarning("Could not delete the branches, none were deleted\n%s" % output)
+
+def delete_branches(branch_names):
+	"""Deletes the local branches with a single git branch, checking out master
+	first if one of them is checked out"""
+
+	if not branch_names:
+		return
+
+	if get_current_branch_name(False) in branch_names:
+		ret = system('git checkout master')
+		if ret != 0:
+			raise UserWarning("Could not checkout master")
+
+	print color_text("Deleting %s %s" % ('branch' if len(branch_names) == 1 else 'branches', ', '.join(branch_names)), 'status')
+	ret = system('git branch -D %s' % ' '.join(branch_names))
+	if ret != 0:
+		raise UserWarning("Could not delete branch")
+
+def display_diff_stats(pull_request, branch_name, merge_base, diff_stats):
+	"""Displays the changes made by a pull request"""
+
+	if options['format'] != 'text':
+		record = {
+			'number': pull_request.get('number'),
+			'title': pull_request.get('title'),
+			'branch': branch_name,
+			'merge_base': merge_base
+		}
+		record.update(diff_stats)
+
+		display_record(record)
+		return
+
+	print " %s files changed, %s insertions(+), %s deletions(-)" % (diff_stats['files'], diff_stats['added'], diff_stats['deleted'])
+
+	extensions = sorted(diff_stats['extensions'].items(), key = lambda item: (-item[1]['files'], item[0]))
+	print ", ".join("%s %s (+%s -%s)" % (extension_stats['files'], extension or '(none)', extension_stats['added'], extension_stats['deleted']) for extension, extension_stats in extensions)
+	print
+
+def display_http_stats():
+	"""Displays how many API requests were made and how many connections they
+	needed"""
+
+	if http_stats['requests'] == 0:
+		return
+
+	print color_text("%s github requests over %s connections (%s reused, %s not modified, %s retried, %s throttled)" % (http_stats['requests'], http_stats['connections'], http_stats['reused'], http_stats['not-modified'], http_stats['retried'], http_stats['throttled']), 'status')
+
+def display_store_age(refreshed_at):
+	"""Displays how old the stored pull request information being used is"""
+
+	print color_text("Using pull request information from %s ago" % format_age(time.time() - refreshed_at), 'status')
+
+def display_timings():
+	"""Displays the total time spent in each category of work and the most
+	costly git commands and github requests"""
+
+	with timings_lock:
+		events = list(timings)
+
+	categories = {}
+	for event in events:
+		count, duration = categories.get(event['cat'], (0, 0))
+		categories[event['cat']] = (count + 1, duration + event['dur'])
+
+	print
+	print color_text("Time spent", 'status')
+
+	for category, (count, duration) in sorted(categories.items(), key = lambda item: -item[1][1]):
+		print "  %8.3fs  %s (%s)" % (duration, category, count)
+
+	print
+	print color_text("Most costly", 'status')
+
+	costly = [event for event in events if event['cat'] != 'command']
+	costly.sort(key = lambda event: -event['dur'])
+
+	for event in costly[:int(options['timings-top'])]:
+		details = ''
+
+		if 'status' in event['args']:
+			details = ' [%s, %s bytes]' % (event['args']['status'], event['args']['bytes'])
+
+		print "  %8.3fs  %s: %s%s" % (event['dur'], event['cat'], event['name'], details)
+
+	print
+
 def display_pull_request(pull_request):
 	"""Nicely display_pull_request info about a given pull request"""
 
@@ -589,13 +1621,87 @@ def display_pull_request_minimal(pull_request):
 
 	print "%s - %s by %s (%s)" % (color_text("REQUEST %s" % pull_request.get('number'), 'display-title-number', True), color_text(pull_request.get('title'), 'display-title-text', True), color_text(pull_request['user'].get('name'), 'display-title-user'), pull_request['user'].get('login'))
 
+def display_record(record):
+	"""Prints a result in the machine readable format, streaming the JSON
+	array one element at a time, or printing one object per line"""
+
+	global data_records
+
+	if options['format'] == 'ndjson':
+		data_output.write(json.dumps(record, sort_keys = True))
+		data_output.write('\n')
+	else:
+		if data_records == 0:
+			data_output.write('[\n')
+		else:
+			data_output.write(',\n')
+
+		data_output.write(json.dumps(record, sort_keys = True))
+
+	data_output.flush()
+
+	data_records += 1
+
+def display_stats_error(pull_request, error):
+	"""Displays why the changes of a pull request, or of the pull request with
+	the number when it could not be retrieved, could not be computed"""
+
+	if not isinstance(pull_request, dict):
+		pull_request = {'number': pull_request}
+
+	if options['format'] != 'text':
+		display_record({
+			'number': pull_request.get('number'),
+			'title': pull_request.get('title'),
+			'error': str(error)
+		})
+
+	print color_text(error, 'error')
+	print
+
 def display_status():
 	"""Displays the current branch name"""
 
 	branch_name = get_current_branch_name(False)
 	print "Current branch: %s" % branch_name
 
-def fetch_pull_request(pull_request):
+def fetch_missing_objects(repo_name, branch_name):
+	"""Fetches the objects of a pull request branch that were skipped by the
+	fetch filter from the fork of the pull request, all at once, so commands
+	that need the complete branch do not depend on git fetching them one by
+	one, possibly after the fork is gone"""
+
+	# Only a partial clone, or a repository a filtered fetch was made into, has
+	# promisor remotes and can be missing objects. Filtered fetches made during
+	# this run add them, so the config read at startup is not enough.
+	ret, output = run_command("git config --get-regexp '^extensions\\.partialclone$|\\.promisor$'")
+
+	if ret != 0 or not output.strip():
+		return
+
+	ret, output = run_command('git rev-list --objects --missing=print master..%s' % branch_name)
+
+	if ret != 0:
+		raise UserWarning("Could not list the objects of %s\n%s" % (branch_name, output))
+
+	missing = [line[1:] for line in output.splitlines() if line.startswith('?')]
+
+	if not missing:
+		return
+
+	pull_request = get_pull_request(repo_name, get_pull_request_ID(branch_name))
+	repo_url = get_repo_url(pull_request)
+
+	print color_text("Fetching %s missing objects of %s" % (len(missing), branch_name), 'status')
+
+	with timed('fetch', 'git fetch --stdin %s (%s objects)' % (repo_url, len(missing))):
+		process = subprocess.Popen(['git', 'fetch', '--no-tags', '--no-write-fetch-head', '--stdin', repo_url], stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+		output = process.communicate(''.join('%s\n' % sha for sha in missing))[0]
+
+	if process.returncode != 0:
+		raise UserWarning("Could not fetch the missing objects of %s, update not performed\n%s" % (branch_name, output))
+
+def fetch_pull_request(repo_name, pull_request):
 	"""Fetches a pull request into a local branch, and returns the name of the
 	local branch"""
 
@@ -604,32 +1710,425 @@ def fetch_pull_request(pull_request):
 
 	remote_branch_name = pull_request['head']['ref']
 
-	ret = os.system('git fetch %s %s:%s' % (repo_url, remote_branch_name, branch_name))
+	ret = system(build_fetch_command(repo_url, ['%s:%s' % (remote_branch_name, branch_name)]))
 
-	if ret != 0:
-		ret = os.system('git show-ref --verify refs/heads/%s' % branch_name)
-
-	if ret != 0:
+	if ret != 0 and not ref_exists('refs/heads/%s' % branch_name):
 		raise UserWarning("Fetch failed")
 
-	try:
-		os.remove('/tmp/git-pull-request-treeish-%s' % pull_request['number'])
-	except OSError:
-		pass
+	save_fetch(repo_name, pull_request)
 
 	return branch_name
 
+def fetch_pull_requests(repo_name, pull_request_pages):
+	"""Fetches pages of pull requests into local branches, and yields the pull
+	request, the output of the fetch, an error message or None and whether the
+	fetch was skipped because the branch was up to date for each of them in
+	order
+
+	Pull requests whose local branch already points at their head commit are
+	skipped. The others are fetched together with a single multi-refspec fetch
+	for each fork they come from in the page, so each remote is negotiated with
+	only once, and the forks are fetched using a pool of concurrent fetches.
+	Later pages are read while the earlier ones are being fetched."""
+
+	local_heads = get_pull_request_branch_heads()
+	order = collections.deque()
+	results = {}
+
+	def groups():
+		seen = set()
+
+		for pull_requests in pull_request_pages:
+			page_groups = []
+			groups_by_url = {}
+
+			for pull_request in pull_requests:
+				# Pull requests can move between pages while they are listed
+				if pull_request['number'] in seen:
+					continue
+
+				seen.add(pull_request['number'])
+
+				head_sha = pull_request['head'].get('sha')
+
+				if head_sha is not None and local_heads.get(build_branch_name(pull_request)) == head_sha:
+					results[pull_request['number']] = (pull_request, "Already up to date", None, True)
+				else:
+					repo_url = get_repo_url(pull_request)
+
+					if repo_url not in groups_by_url:
+						groups_by_url[repo_url] = []
+						page_groups.append((repo_url, groups_by_url[repo_url]))
+
+					groups_by_url[repo_url].append(pull_request)
+
+				order.append(pull_request['number'])
+
+			for group in page_groups:
+				yield group
+
+	def fetch(group):
+		repo_url, group_pull_requests = group
+
+		refspecs = ['%s:%s' % (pull_request['head']['ref'], build_branch_name(pull_request)) for pull_request in group_pull_requests]
+		ret, output = run_command(build_fetch_command(repo_url, refspecs))
+
+		if ret == 0:
+			results = []
+
+			for pull_request in group_pull_requests:
+				branch_name = build_branch_name(pull_request)
+				lines = [line for line in output.splitlines() if line.endswith(' %s' % branch_name)]
+				results.append((pull_request, '\n'.join(lines), None))
+		elif len(group_pull_requests) == 1:
+			results = [fetch_pull_request_quietly(group_pull_requests[0], ret, output)]
+		else:
+			# Fetch each pull request on its own so one missing or rejected
+			# branch does not fail the whole fork
+			results = [fetch_pull_request_quietly(pull_request) for pull_request in group_pull_requests]
+
+		for pull_request, output, error in results:
+			if error is None:
+				save_fetch(repo_name, pull_request)
+
+		return [result + (False,) for result in results]
+
+	for group_results in run_jobs(fetch, groups(), int(options['fetch-jobs'])):
+		for result in group_results:
+			results[result[0]['number']] = result
+
+		# Forks are ordered by their first pull request, so every pull request
+		# before the ones of the next fork is done
+		while order and order[0] in results:
+			yield results.pop(order.popleft())
+
+	while order:
+		yield results.pop(order.popleft())
+
+def fetch_pull_request_quietly(pull_request, ret = None, output = None):
+	"""Fetches a pull request into a local branch with its output captured, and
+	returns the pull request, the output of the fetch and an error message or
+	None. The status and output of a fetch that was already run can be
+	passed in to avoid running it again."""
+
+	branch_name = build_branch_name(pull_request)
+	repo_url = get_repo_url(pull_request)
+
+	remote_branch_name = pull_request['head']['ref']
+
+	if ret is None:
+		ret, output = run_command(build_fetch_command(repo_url, ['%s:%s' % (remote_branch_name, branch_name)]))
+
+	if ret != 0 and not ref_exists('refs/heads/%s' % branch_name):
+		return pull_request, output, "Fetch failed"
+
+	return pull_request, output, None
+
+def finish_records():
+	"""Ends the output of results in the machine readable format"""
+
+	if options['format'] in ('text', 'ndjson'):
+		return
+
+	if data_records == 0:
+		data_output.write('[')
+
+	data_output.write('\n]\n')
+	data_output.flush()
+
+def format_age(seconds):
+	"""Returns a number of seconds as a human readable age"""
+
+	for unit, size in (('day', 86400), ('hour', 3600), ('minute', 60)):
+		if seconds >= size:
+			count = int(seconds // size)
+			break
+	else:
+		unit = 'second'
+		count = int(max(seconds, 0))
+
+	if count == 1:
+		return "1 %s" % unit
+
+	return "%s %ss" % (count, unit)
+
 def get_current_branch_name(ensure_pull_request = True):
 	"""Returns the name of the current pull request branch"""
-	branch_name = os.popen('git rev-parse --abbrev-ref HEAD').read().strip()
+	branch_name = get_git_fact('current-branch', 'git rev-parse --abbrev-ref HEAD')
 
 	if ensure_pull_request and branch_name[0:13] != 'pull-request-':
 		raise UserWarning("Invalid branch: not a pull request")
 
 	return branch_name
 
+def get_local_branch_heads(pattern):
+	"""Returns the commits the local branches matching the pattern point at,
+	keyed by branch name, using a single for-each-ref"""
+
+	ret, output = run_command("git for-each-ref --format='%%(objectname) %%(refname:short)' 'refs/heads/%s'" % pattern)
+
+	heads = {}
+	for line in output.splitlines():
+		sha, branch_name = line.split(' ', 1)
+		heads[branch_name] = sha
+
+	return heads
+
+def get_memo(kind, base_sha, head_sha):
+	"""Returns the remembered result of a computation on two commit SHAs, or
+	None if it has not been remembered. Results are kept in the local store,
+	since they never change for the same two commits."""
+
+	with store_lock:
+		with get_store():
+			row = get_store().execute(
+				"SELECT value FROM memos WHERE kind = ? AND base_sha = ? AND head_sha = ?",
+				(kind, base_sha, head_sha)).fetchone()
+
+			if row is None:
+				return None
+
+			get_store().execute(
+				"UPDATE memos SET used_at = ? WHERE kind = ? AND base_sha = ? AND head_sha = ?",
+				(time.time(), kind, base_sha, head_sha))
+
+	return json.loads(row['value'])
+
+def get_merge_base(base_sha, head_sha):
+	"""Returns the merge base of two commit SHAs"""
+
+	merge_base = get_memo('merge-base', base_sha, head_sha)
+
+	if merge_base is not None:
+		return merge_base
+
+	ret, merge_base = run_command('git merge-base %s %s' % (base_sha, head_sha))
+	merge_base = merge_base.strip()
+
+	if ret != 0 or merge_base == '':
+		raise UserWarning("Could not find the merge base of %s and %s" % (base_sha, head_sha))
+
+	save_memo('merge-base', base_sha, head_sha, merge_base)
+
+	return merge_base
+
+def get_object_info(name):
+	"""Returns the SHA and type of the object a name such as a ref or
+	'<ref>^{commit}' points at, or None if there is no such object
+
+	Lookups are answered by a long lived git cat-file --batch-check process
+	instead of starting a new git process for every lookup."""
+
+	key = os.getcwd()
+
+	with git_object_lookups_lock:
+		process = git_object_lookups.get(key)
+
+		if process is None or process.poll() is not None:
+			process = subprocess.Popen(['git', 'cat-file', '--batch-check'], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+			git_object_lookups[key] = process
+
+		with timed('git', 'git cat-file --batch-check %s' % name):
+			process.stdin.write('%s\n' % name)
+			process.stdin.flush()
+
+			fields = process.stdout.readline().split()
+
+	if len(fields) != 3:
+		return None
+
+	return fields[0], fields[1]
+
+def get_merge_conflicts(base_sha, head_sha):
+	"""Returns the files that would conflict when merging two commit SHAs,
+	computed with an in-memory merge"""
+
+	conflicts = get_memo('merge-conflicts', base_sha, head_sha)
+
+	if conflicts is not None:
+		return conflicts
+
+	with timed('merge', 'git merge-tree %s %s' % (base_sha, head_sha)):
+		process = subprocess.Popen(['git', 'merge-tree', '--write-tree', '--name-only', '--no-messages', '-z', base_sha, head_sha], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+		output, error = process.communicate()
+
+	# The written tree comes first, followed by the conflicting files when the
+	# merge is not clean
+	fields = [field for field in output.split('\0') if field]
+
+	if process.returncode not in (0, 1) or not fields:
+		raise UserWarning("Could not merge %s into %s, git 2.38 or newer is required\n%s" % (head_sha, base_sha, error.strip()))
+
+	conflicts = fields[1:] if process.returncode == 1 else []
+
+	save_memo('merge-conflicts', base_sha, head_sha, conflicts)
+
+	return conflicts
+
+def get_original_commits(repo_name, pull_request_ID):
+	"""Returns the range of commits the pull request branch had before it was
+	last updated from master, or None if it has not been updated since it was
+	fetched"""
+
+	with store_lock:
+		row = get_store().execute(
+			"SELECT original_commits FROM pull_requests WHERE repo_name = ? AND number = ?",
+			(repo_name, int(pull_request_ID))).fetchone()
+
+	if row is None:
+		return None
+
+	return row['original_commits']
+
+def get_diff_stats(base, head):
+	"""Returns the number of files changed and lines added and deleted between
+	two commit SHAs, in total and for each file extension
+
+	The diff is read as a stream from a single git diff, so only the totals are
+	kept in memory however many files were changed."""
+
+	diff_stats = get_memo('diff-stats', base, head)
+
+	if diff_stats is not None:
+		return diff_stats
+
+	diff_stats = {'files': 0, 'added': 0, 'deleted': 0, 'extensions': {}}
+
+	with timed('git', 'git diff --numstat %s..%s' % (base, head)):
+		process = subprocess.Popen(['git', 'diff', '--numstat', '-z', '--no-renames', '%s..%s' % (base, head)], stdout = subprocess.PIPE)
+
+		remainder = ''
+		while True:
+			chunk = process.stdout.read(65536)
+
+			if not chunk:
+				break
+
+			records = (remainder + chunk).split('\0')
+			remainder = records.pop()
+
+			for record in records:
+				if record:
+					add_diff_stat(diff_stats, record)
+
+		if remainder:
+			add_diff_stat(diff_stats, remainder)
+
+		process.wait()
+
+	if process.returncode != 0:
+		raise UserWarning("Could not compute the changes between %s and %s" % (base, head))
+
+	save_memo('diff-stats', base, head, diff_stats)
+
+	return diff_stats
+
+def get_changed_paths(base, head):
+	"""Returns the paths of the files changed between two commit SHAs"""
+
+	paths = get_memo('changed-paths', base, head)
+
+	if paths is not None:
+		return paths
+
+	ret, output = run_command('git diff --name-only -z --no-renames %s..%s' % (base, head))
+
+	if ret != 0:
+		raise UserWarning("Could not compute the changes between %s and %s" % (base, head))
+
+	paths = [path.decode('utf-8', 'replace') for path in output.split('\0') if path]
+
+	save_memo('changed-paths', base, head, paths)
+
+	return paths
+
+def get_command_category(command):
+	"""Returns the category a command is timed under, which is the phase of
+	the work for the git commands that fetch, merge or checkout"""
+
+	m = re.match(r'\s*git\s+(\S+)', command)
+
+	if m is None:
+		return 'process'
+
+	phases = {
+		'fetch': 'fetch',
+		'pull': 'fetch',
+		'merge': 'merge',
+		'rebase': 'merge',
+		'commit': 'merge',
+		'checkout': 'checkout',
+		'reset': 'checkout'
+	}
+
+	return phases.get(m.group(1), 'git')
+
+def get_auth_string():
+	"""Returns the encoded github credentials used to authorize requests"""
+
+	global auth_string
+
+	with auth_lock:
+		if auth_string is None:
+			import base64
+
+			username, auth_token = get_github_credentials()
+
+			auth_user = "%s/token" % username
+			auth_string = base64.encodestring('%s:%s' % (auth_user, auth_token)).replace('\n', '')
+
+		return auth_string
+
+def get_checked_out_branches():
+	"""Returns the paths of the worktrees of the repository that have a branch
+	checked out, keyed by branch name"""
+
+	ret, output = run_command('git worktree list --porcelain')
+
+	if ret != 0:
+		raise UserWarning("Could not list worktrees\n%s" % output)
+
+	branches = {}
+	worktree_path = None
+
+	for line in output.splitlines():
+		if line.startswith('worktree '):
+			worktree_path = line[len('worktree '):]
+		elif line.startswith('branch refs/heads/'):
+			branches[line[len('branch refs/heads/'):]] = worktree_path
+
+	return branches
+
+def get_commit_shas(*refs):
+	"""Returns the commit SHAs the refs point at"""
+
+	shas = []
+	for ref in refs:
+		object_info = get_object_info('%s^{commit}' % ref)
+
+		if object_info is None:
+			raise UserWarning("Could not resolve %s" % ref)
+
+		shas.append(object_info[0])
+
+	return shas
+
+def get_cpu_count():
+	"""Returns the number of processors, which is the default number of jobs
+	for the commands working on local git objects"""
+
+	import multiprocessing
+
+	return multiprocessing.cpu_count()
+
+def get_daemon_socket_path():
+	"""Returns the path of the socket the daemon serving the repository
+	listens on"""
+
+	return os.path.join(get_git_common_dir(), 'git-pull-request.sock')
+
 def get_default_repo_name():
-	repo_name = os.popen('git config github.repo').read().strip()
+	repo_name = get_git_config('github.repo')
 
 	# get repo name from origin
 	if repo_name is None or repo_name == '':
@@ -641,7 +2140,31 @@ def get_default_repo_name():
 	return repo_name
 
 def get_git_base_path():
-	return os.popen('git rev-parse --show-toplevel').read().strip()
+	return get_git_fact('toplevel', 'git rev-parse --show-toplevel')
+
+def get_git_common_dir():
+	"""Returns the path of the git directory shared by all worktrees"""
+
+	return os.path.abspath(get_git_fact('common-dir', 'git rev-parse --git-common-dir'))
+
+def get_git_config(key):
+	"""Returns the value of a git config setting, or an empty string if it is
+	not set"""
+
+	return git_config.get(key, '')
+
+def get_git_fact(name, command):
+	"""Returns the output of a git command that queries the repository,
+	running it only once for each working directory during this run"""
+
+	key = (os.getcwd(), name)
+
+	with git_facts_lock:
+		if key not in git_facts:
+			with timed('git', command):
+				git_facts[key] = os.popen(command).read().strip()
+
+		return git_facts[key]
 
 def get_original_dir_path():
 	git_base_path = get_git_base_path()
@@ -649,33 +2172,267 @@ def get_original_dir_path():
 	return os.path.dirname(os.path.dirname(config_path))
 
 def get_pull_request(repo_name, pull_request_ID):
-	"""Returns information retrieved from github about the pull request"""
+	"""Returns information retrieved from github about the pull request, or
+	from the local store if it was retrieved recently enough"""
+
+	stored = get_stored_pull_request(repo_name, pull_request_ID, get_store_max_age())
+
+	if stored is not None:
+		pull_request, refreshed_at = stored
+		display_store_age(refreshed_at)
+		return pull_request
+
+	if options['offline']:
+		raise UserWarning("Pull request %s is not stored locally, run without --offline to retrieve it" % pull_request_ID)
 
 	url = "http://github.com/api/v2/json/pulls/%s/%s" % (repo_name, pull_request_ID)
 	data = github_json_request(url)
 
+	save_pull_requests(repo_name, [data['pull']])
+
 	return data['pull']
 
+def get_selected_pull_request_IDs(repo_name, pull_request_IDs = None, search_terms = None):
+	"""Returns the IDs of the pull requests given, followed by those of the
+	open pull requests matching the search terms"""
+
+	selected_IDs = [int(pull_request_ID) for pull_request_ID in pull_request_IDs or []]
+
+	if search_terms:
+		for pull_request in search_pull_requests(repo_name, search_terms):
+			if pull_request['number'] not in selected_IDs:
+				selected_IDs.append(pull_request['number'])
+
+		if not selected_IDs:
+			raise UserWarning("No open pull requests match %s" % ' '.join(search_terms))
+
+	return selected_IDs
+
+def get_search_terms(pull_request):
+	"""Returns the kinds and terms a pull request is found by in searches,
+	apart from the paths it changes"""
+
+	terms = set()
+
+	user = pull_request.get('user') or {}
+
+	for name in (user.get('login'), user.get('name')):
+		for word in re.findall(r'\w+', (name or '').lower(), re.UNICODE):
+			terms.add(('author', word))
+
+	if user.get('login'):
+		terms.add(('author', user['login'].lower()))
+
+	title = pull_request.get('title') or ''
+	head = pull_request.get('head') or {}
+
+	for key in re.findall(r'[A-Z]{3,}-\d+', '%s %s' % (title, head.get('ref') or '')):
+		terms.add(('key', key))
+
+	for word in re.findall(r'\w+', title.lower(), re.UNICODE):
+		terms.add(('word', word))
+
+	return terms
+
+def get_pull_requests_by_ID(repo_name, pull_request_IDs):
+	"""Yields the ID, the pull request or None and an error message or None
+	for each of the IDs in order, retrieving the pull requests not stored
+	recently enough from github concurrently"""
+
+	def get(pull_request_ID):
+		try:
+			pull_request_ID = int(pull_request_ID)
+		except ValueError:
+			return pull_request_ID, None, UserWarning("Invalid pull request ID: %s" % pull_request_ID)
+
+		try:
+			return pull_request_ID, get_pull_request(repo_name, pull_request_ID), None
+		except UserWarning, e:
+			return pull_request_ID, None, e
+
+	return github_json_requests(get, pull_request_IDs)
+
 def get_pull_requests(repo_name):
-	"""Returns information retrieved from github about the open pull requests on
-	the repository"""
+	"""Yields information about the open pull requests on the repository as
+	each page of them is retrieved"""
+
+	for pull_requests in get_pull_request_pages(repo_name):
+		for pull_request in pull_requests:
+			yield pull_request
+
+def get_pull_request_pages(repo_name):
+	"""Yields information retrieved from github about the open pull requests on
+	the repository one page at a time, following the pagination links, or from
+	the local store if they were retrieved recently enough
+
+	Only one page is held at a time, so memory use does not grow with the
+	number of open pull requests."""
+
+	stored = get_stored_pull_request_pages(repo_name, get_store_max_age())
+
+	if stored is not None:
+		return stored
 
+	if options['offline']:
+		raise UserWarning("The open pull requests for %s are not stored locally, run without --offline to retrieve them" % repo_name)
+
+	return get_github_pull_request_pages(repo_name)
+
+def get_github_credentials():
+	"""Returns the github username and API token, asking for them the first
+	time they are needed if they are not set in git config"""
+
+	username = get_git_config('github.user')
+	auth_token = get_git_config('github.token')
+
+	if len(username) == 0:
+		username = raw_input("Github username: ").strip()
+		system("git config --global github.user %s" % username)
+		git_config['github.user'] = username
+
+	if len(auth_token) == 0:
+		print "Please go to https://github.com/account/admin to find your API token"
+		auth_token = raw_input("Github API token: ").strip()
+		system("git config --global github.token %s" % auth_token)
+		git_config['github.token'] = auth_token
+
+	return username, auth_token
+
+def get_github_pull_request_pages(repo_name):
+	"""Yields the open pull requests on the repository retrieved from github
+	one page at a time, storing each page as it arrives"""
+
+	listed_at = time.time()
 	url = "http://github.com/api/v2/json/pulls/%s/open" % repo_name
-	data = github_json_request(url)
 
-	return data['pulls']
+	while url is not None:
+		data, url = github_json_response(url)
+
+		save_pull_requests(repo_name, data['pulls'])
+
+		yield data['pulls']
+
+	save_pull_request_list(repo_name, listed_at)
+
+def get_stored_pull_request(repo_name, pull_request_ID, max_age = None):
+	"""Returns the pull request from the local store along with the time it
+	was refreshed, or None if it is not stored or was refreshed more than
+	max_age seconds ago"""
+
+	with store_lock:
+		row = get_store().execute(
+			"SELECT data, refreshed_at FROM pull_requests WHERE repo_name = ? AND number = ?",
+			(repo_name, int(pull_request_ID))).fetchone()
+
+	if row is None or row['data'] is None:
+		return None
+
+	if max_age is not None and time.time() - row['refreshed_at'] > max_age:
+		return None
+
+	return json.loads(row['data']), row['refreshed_at']
+
+def get_stored_pull_request_pages(repo_name, max_age = None):
+	"""Returns a generator of pages of the open pull requests in the local
+	store, or None if they were never listed or were listed more than max_age
+	seconds ago"""
+
+	with store_lock:
+		row = get_store().execute(
+			"SELECT refreshed_at FROM pull_request_lists WHERE repo_name = ?",
+			(repo_name,)).fetchone()
+
+	if row is None:
+		return None
+
+	if max_age is not None and time.time() - row['refreshed_at'] > max_age:
+		return None
+
+	def pages():
+		display_store_age(row['refreshed_at'])
+
+		# Read a page at a time, since the store may be written to in between
+		last_number = sys.maxint
+
+		while True:
+			with store_lock:
+				rows = get_store().execute(
+					"SELECT number, data FROM pull_requests WHERE repo_name = ? AND state = 'open' AND data IS NOT NULL AND number < ? ORDER BY number DESC LIMIT 100",
+					(repo_name, last_number)).fetchall()
+
+			if not rows:
+				return
+
+			last_number = rows[-1]['number']
+
+			yield [json.loads(pull_request_row['data']) for pull_request_row in rows]
+
+	return pages()
+
+def get_store_max_age():
+	"""Returns the number of seconds stored pull request information can be
+	used for, or None if it can be used regardless of its age"""
+
+	if options['offline']:
+		return None
+
+	return float(options['store-max-age'])
+
+def get_pull_request_stats(pull_request):
+	"""Returns the local branch name and merge base of a fetched pull request,
+	along with the changes it makes"""
+
+	branch_name = build_branch_name(pull_request)
+
+	master_sha, head_sha = get_commit_shas('master', branch_name)
+	merge_base = get_merge_base(master_sha, head_sha)
+
+	return branch_name, merge_base, get_diff_stats(merge_base, head_sha)
+
+def get_pull_request_branch_heads():
+	"""Returns the commits the local pull request branches point at, keyed by
+	branch name, leaving out branches like pull-request-template that only
+	share the prefix"""
+
+	heads = get_local_branch_heads('pull-request-*')
+
+	return dict((branch_name, sha) for branch_name, sha in heads.items() if re.search("^pull-request-\d+", branch_name))
 
 def get_pull_request_ID(branch_name):
 	"""Returns the pull request number of the branch with the name"""
 
 	m = re.search("^pull-request-(\d+)", branch_name)
 
+	if m is None:
+		raise UserWarning("%s is not a pull request branch" % branch_name)
+
 	return int(m.group(1))
 
+def get_refs_size():
+	"""Returns the number of bytes of disk space used by the refs of the
+	repository and their reflogs"""
+
+	common_dir = get_git_common_dir()
+	paths = [os.path.join(common_dir, 'packed-refs')]
+
+	for refs_dir in (os.path.join(common_dir, 'refs'), os.path.join(common_dir, 'logs', 'refs')):
+		for dir_path, dir_names, file_names in os.walk(refs_dir):
+			paths.extend(os.path.join(dir_path, file_name) for file_name in file_names)
+
+	size = 0
+
+	for path in paths:
+		try:
+			size += os.lstat(path).st_blocks * 512
+		except OSError:
+			pass
+
+	return size
+
 def get_repo_name_for_remote(remote_name):
 	"""Returns the repository name for the remote with the name"""
 
-	remotes = os.popen('git remote -v').read()
+	remotes = get_git_fact('remotes', 'git remote -v')
 	m = re.search("^%s[^\n]+?github\.com[^\n]*?[:/]([^\n]+?)\.git" % remote_name, remotes, re.MULTILINE)
 
 	if m is not None and m.group(1) != '':
@@ -690,30 +2447,220 @@ def get_repo_url(pull_request):
 	if private_repo:
 		repo_url = repo_url.replace('git://github.com/', 'git@github.com:')
 
-	return repo_url
+	return repo_url
+
+def get_store():
+	"""Returns the connection to the local pull request store, which is kept
+	in the git directory of the repository and created when first needed"""
+
+	global store
+
+	with store_lock:
+		if store is None:
+			connection = sqlite3.connect(get_store_path(), timeout = 30, check_same_thread = False)
+			connection.row_factory = sqlite3.Row
+
+			with connection:
+				for statement in store_schema:
+					connection.execute(statement)
+
+			store = connection
+
+	return store
+
+def get_store_path():
+	"""Returns the path of the local pull request store, which is shared by
+	the work directory and the original directory"""
+
+	if in_work_dir():
+		git_dir = os.path.join(get_original_dir_path(), '.git')
+	else:
+		git_dir = get_git_common_dir()
+
+	return os.path.join(git_dir, 'git-pull-request.db')
+
+def get_update_worktrees_path():
+	"""Returns the directory holding the pool of worktrees used by
+	update-all"""
+
+	return os.path.join(get_git_common_dir(), 'git-pull-request', 'worktrees')
+
+def get_http_cache_path(url):
+	"""Returns the path of the cache file for the url, which is keyed by the
+	credentials used so different users never share responses"""
+
+	cache_dir = os.path.expanduser(options['http-cache-dir'])
+	key = hashlib.sha1('%s\n%s' % (get_auth_string(), url)).hexdigest()
+
+	return os.path.join(cache_dir, key)
+
+def get_http_connection(scheme, host, fresh = False):
+	"""Returns an idle keep-alive connection to the host, or a new one if there
+	is none, along with whether the connection was reused"""
+
+	with http_connections_lock:
+		idle = http_connections.setdefault((scheme, host), [])
+
+		if idle and not fresh:
+			http_stats['reused'] += 1
+			return idle.pop(), True
+
+		http_stats['connections'] += 1
+
+	import httplib
+
+	timeout = float(options['http-timeout'])
+
+	if scheme == 'https':
+		return httplib.HTTPSConnection(host, timeout = timeout), False
+
+	return httplib.HTTPConnection(host, timeout = timeout), False
+
+def github_json_request(url, params = None):
+	return github_json_response(url, params)[0]
+
+def github_json_requests(function, items):
+	"""Calls a function making github requests on every item concurrently,
+	with at most api-jobs requests at a time, and yields the results in order
+
+	The requests share the pool of keep-alive connections and the rate limit,
+	so this is the way to fan out many lookups without waiting for each
+	round trip in turn."""
+
+	return run_jobs(function, items, int(options['api-jobs']))
+
+def github_json_response(url, params = None):
+	"""Performs a github API request, and returns the decoded response along
+	with the URL of the next page of results, or None if it is the last
+	page"""
+
+	if options['offline']:
+		raise UserWarning("Cannot contact github in offline mode: %s" % url)
+
+	headers = {}
+	authorize_request(headers)
+
+	if params is not None:
+		import urllib
+
+		method = 'POST'
+		body = urllib.urlencode(params)
+		headers['Content-Type'] = 'application/x-www-form-urlencoded'
+	else:
+		method = 'GET'
+		body = None
+
+	cache_entry = None
+
+	if method == 'GET' and options['http-cache']:
+		cache_entry = read_http_cache(url)
+
+	if cache_entry is not None:
+		if cache_entry.get('etag'):
+			headers['If-None-Match'] = cache_entry['etag']
+		if cache_entry.get('last-modified'):
+			headers['If-Modified-Since'] = cache_entry['last-modified']
+
+	# The daemon refreshes while commands are answered with their output
+	# captured, which must not collect the URLs of the refresh
+	if threading.current_thread().name != 'daemon-refresh':
+		print url
+
+	status, reason, response_headers, data = scheduled_request(method, url, body, headers)
+
+	if status == 304 and cache_entry is not None:
+		with http_connections_lock:
+			http_stats['not-modified'] += 1
+
+		touch_http_cache(url)
+		data = cache_entry['body']
+		link = cache_entry.get('link')
+	else:
+		link = response_headers.getheader('link')
+
+	if status == 200 and method == 'GET' and options['http-cache']:
+		write_http_cache(url, response_headers, data)
+
+	if status >= 400:
+		raise UserWarning("Error communicating with github: %s\nHTTP Error %s: %s" % (url, status, reason))
+
+	if data == '':
+		raise UserWarning("Invalid response from github")
+
+	data = json.loads(data)
+	# print json.dumps(data,sort_keys=True, indent=4)
+
+	m = re.search('<([^>]+)>;\\s*rel="next"', link or '')
+
+	if m is not None:
+		return data, m.group(1)
+
+	return data, None
+
+def http_request(method, url, body = None, headers = {}, redirects = 5):
+	"""Performs an HTTP request over a pooled keep-alive connection, following
+	redirects, and returns the status, reason, headers and body of the
+	response. Connection failures raise httplib.HTTPException or
+	socket.error."""
+
+	import httplib
+	import socket
+	import urlparse
+
+	scheme, host, path, query, fragment = urlparse.urlsplit(url)
+
+	if query:
+		path = '%s?%s' % (path, query)
+
+	conn, reused = get_http_connection(scheme, host)
+
+	with http_connections_lock:
+		http_stats['requests'] += 1
+
+	try:
+		try:
+			conn.request(method, path or '/', body, headers)
+			response = conn.getresponse()
+		except (httplib.HTTPException, socket.error):
+			# The server may have dropped an idle connection since it was last
+			# used, so retry once on a new one before giving up
+			conn.close()
+
+			if not reused:
+				raise
+
+			conn, reused = get_http_connection(scheme, host, True)
+			conn.request(method, path or '/', body, headers)
+			response = conn.getresponse()
+
+		data = response.read()
+	except (httplib.HTTPException, socket.error):
+		conn.close()
+		raise
+
+	if response.will_close:
+		conn.close()
+	else:
+		release_http_connection(scheme, host, conn)
+
+	location = response.getheader('location')
 
-def github_json_request(url, params = None):
-	if params is not None:
-		data = urllib.urlencode(params)
-		req = urllib2.Request(url, data)
-	else:
-		req = urllib2.Request(url)
+	if response.status in (301, 302, 303, 307) and location and redirects > 0:
+		if response.status == 303:
+			method = 'GET'
+			body = None
 
-	authorize_request(req)
-	print url
+		return http_request(method, urlparse.urljoin(url, location), body, headers, redirects - 1)
 
-	try:
-		response = urllib2.urlopen(req)
-	except urllib2.HTTPError, msg:
-		raise UserWarning("Error communicating with github: %s\n%s" % (url, msg))
+	return response.status, response.reason, response.msg, data
 
-	data = response.read()
-	if data == '':
-		raise UserWarning("Invalid response from github")
+def in_update_worktree():
+	"""Returns whether the current directory is a worktree of the pool used by
+	update-all"""
 
-	data = json.loads(data)
-	# print json.dumps(data,sort_keys=True, indent=4)
-	return data
+	git_base_path = get_git_base_path()
+
+	return os.path.dirname(git_base_path) == get_update_worktrees_path()
 
 def in_work_dir():
 	git_base_path = get_git_base_path()
@@ -721,7 +2668,12 @@ def in_work_dir():
 	return os.path.islink(os.path.join(git_base_path, '.git', 'config'))
 
 def load_options():
-	all_config = os.popen('git config -l').read().strip()
+	with timed('git', 'git config -l'):
+		all_config = os.popen('git config -l').read().strip()
+
+	for line in all_config.splitlines():
+		key, separator, value = line.partition('=')
+		git_config[key] = value
 
 	matches = re.findall("^git-pull-request\.([^=]+)=([^\n]*)$", all_config, re.MULTILINE)
 	for k in matches:
@@ -739,7 +2691,7 @@ def load_options():
 def main():
 	# parse command line options
 	try:
-		opts, args = getopt.gnu_getopt(sys.argv[1:], 'hqr:u:l:', ['help', 'quiet', 'repo=', 'reviewer=', 'update', 'no-update', 'user='])
+		opts, args = getopt.gnu_getopt(sys.argv[1:], 'hqr:u:l:', ['help', 'quiet', 'repo=', 'reviewer=', 'update', 'no-update', 'user=', 'offline', 'max-age=', 'format=', 'timings', 'filter=', 'pack-refs'])
 	except getopt.GetoptError, e:
 		raise UserWarning("%s\nFor help use --help" % e)
 
@@ -750,29 +2702,13 @@ def main():
 	# load git options
 	load_options()
 
-	global auth_string
-
 	repo_name = None
 	reviewer_repo_name = None
 
-	username = os.popen('git config github.user').read().strip()
-	auth_token = os.popen('git config github.token').read().strip()
-
-	if len(username) == 0:
-		username = raw_input("Github username: ").strip()
-		os.system("git config --global github.user %s" % username)
-
-	if len(auth_token) == 0:
-		print "Please go to https://github.com/account/admin to find your API token"
-		auth_token = raw_input("Github API token: ").strip()
-		os.system("git config --global github.token %s" % auth_token)
-
-	auth_user = "%s/token" % username
-	auth_string = base64.encodestring('%s:%s' % (auth_user, auth_token)).replace('\n', '')
-
 	fetch_auto_update = options['fetch-auto-update']
 
-	info_user = username
+	info_user = None
+	search_terms = None
 	submitOpenGitHub = options['submit-open-github']
 
 	# process options
@@ -795,23 +2731,54 @@ def main():
 			fetch_auto_update = True
 		elif o == '--no-update':
 			fetch_auto_update = False
+		elif o == '--offline':
+			options['offline'] = True
+		elif o == '--format':
+			options['format'] = a
+		elif o == '--timings':
+			options['timings'] = True
+		elif o == '--filter':
+			search_terms = a.split()
+		elif o == '--pack-refs':
+			options['prune-pack-refs'] = True
+		elif o == '--max-age':
+			try:
+				options['store-max-age'] = float(a)
+			except ValueError:
+				raise UserWarning("Invalid --max-age: %s" % a)
+
+	if options['format'] not in ('text', 'json', 'ndjson'):
+		raise UserWarning("Invalid format: %s" % options['format'])
+
+	if len(args) == 0 or args[0] in ('open', 'search', 'stat'):
+		if options['daemon'] and not daemon_serving and not (options['timings'] or options['trace-file'] or options['http-stats']):
+			status = query_daemon(sys.argv[1:])
+
+			if status is not None:
+				sys.exit(status)
+
+	if options['format'] != 'text':
+		# Keep standard output for the results alone
+		sys.stdout = sys.stderr
 
 	# get repo name from git config
 	if repo_name is None or repo_name == '':
 		repo_name = get_default_repo_name()
 
 	if reviewer_repo_name is None or reviewer_repo_name == '':
-		reviewer_repo_name = os.popen('git config github.reviewer').read().strip()
+		reviewer_repo_name = get_git_config('github.reviewer')
 
 	# process arguments
 	if len(args) > 0:
 		if args[0] == 'close':
-			if len(args) >= 2:
-				command_close(repo_name, args[1])
-			else:
-				command_close(repo_name)
+			pull_request_IDs, comment = split_pull_request_IDs(args[1:])
+			command_close(repo_name, pull_request_IDs, comment, search_terms)
+		elif args[0] == 'conflicts':
+			command_conflicts()
 		elif args[0] in ('continue-update', 'cu'):
 			command_continue_update()
+		elif args[0] == 'daemon':
+			command_daemon(repo_name)
 		elif args[0] == 'fetch':
 			command_fetch(repo_name, args[1], fetch_auto_update)
 		elif args[0] == 'fetch-all':
@@ -819,19 +2786,21 @@ def main():
 		elif args[0] == 'help':
 			command_help()
 		elif args[0] == 'info':
-			command_info(info_user)
+			command_info(info_user or get_github_credentials()[0])
 		elif args[0] == 'merge':
-			if len(args) >= 2:
-				command_merge(repo_name, args[1])
-			else:
-				command_merge(repo_name)
+			pull_request_IDs, comment = split_pull_request_IDs(args[1:])
+			command_merge(repo_name, pull_request_IDs, comment, search_terms)
 		elif args[0] == 'open':
 			if len(args) >= 2:
 				command_open(repo_name, args[1])
 			else:
 				command_open(repo_name)
+		elif args[0] == 'prune':
+			command_prune(repo_name)
 		elif args[0] == 'pull':
 			command_pull(repo_name)
+		elif args[0] == 'search':
+			command_search(repo_name, args[1:])
 		elif args[0] == 'submit':
 			pull_body = None
 			pull_title = None
@@ -842,19 +2811,21 @@ def main():
 			if len(args) >= 3:
 				pull_title = args[2]
 
-			command_submit(repo_name, username, reviewer_repo_name, pull_body, pull_title, submitOpenGitHub)
+			command_submit(repo_name, get_github_credentials()[0], reviewer_repo_name, pull_body, pull_title, submitOpenGitHub)
 		elif args[0] == 'update':
 			if len(args) >= 2:
 					command_update(repo_name, args[1])
 			else:
 				command_update(repo_name)
+		elif args[0] == 'update-all':
+			command_update_all(repo_name)
 		elif args[0] == 'stat':
-			pull_request_ID = None
-
+			command_stat(repo_name, args[1:])
+		elif args[0] == 'watch':
 			if len(args) >= 2:
-				pull_request_ID = args[1]
+				options['watch-action'] = args[1]
 
-			get_pr_stats(repo_name, pull_request_ID)
+			command_watch(repo_name)
 		else:
 			command_fetch(repo_name, args[0], fetch_auto_update)
 	else:
@@ -863,31 +2834,740 @@ def main():
 def open_URL(url):
 	os.system('open -g "%s"' % url)
 
+def parse_search_query(terms):
+	"""Returns the kind and normalized term of every search term"""
+
+	query = []
+
+	for term in terms:
+		term = term.decode('utf-8', 'replace')
+		kind, separator, value = term.partition(':')
+
+		if separator and kind in ('author', 'key', 'path'):
+			term = value
+		elif re.match(r'^[A-Za-z]{3,}-\d+$', term):
+			kind = 'key'
+		else:
+			# Words are indexed without punctuation, so look for each of them
+			for word in re.findall(r'\w+', term.lower(), re.UNICODE):
+				query.append(('text', word))
+
+			continue
+
+		if kind == 'key':
+			term = term.upper()
+		elif kind == 'author':
+			term = term.lower()
+
+		if not term:
+			raise UserWarning("Missing search term after %s:" % kind)
+
+		query.append((kind, term))
+
+	if not query:
+		raise UserWarning("Please specify what to search for")
+
+	return query
+
 def post_comment(repo_name, pull_request_ID, comment):
 	url = "http://github.com/api/v2/json/issues/comment/%s/%s" % (repo_name, pull_request_ID)
 	params = {'comment': comment}
 	github_json_request(url, params)
 
-def update_branch(branch_name):
-	if in_work_dir():
+def prune_http_cache():
+	"""Evicts cached responses that have not been used for longer than the
+	maximum age, then the least recently used ones until the cache fits in its
+	maximum size"""
+
+	cache_dir = os.path.expanduser(options['http-cache-dir'])
+	max_age = float(options['http-cache-max-age'])
+	max_size = int(options['http-cache-max-size'])
+	now = time.time()
+
+	entries = []
+	for name in os.listdir(cache_dir):
+		path = os.path.join(cache_dir, name)
+
+		try:
+			stat = os.stat(path)
+		except OSError:
+			continue
+
+		if now - stat.st_mtime > max_age:
+			remove_file(path)
+		else:
+			entries.append((stat.st_mtime, stat.st_size, path))
+
+	total_size = sum(size for mtime, size, path in entries)
+
+	for mtime, size, path in sorted(entries):
+		if total_size <= max_size:
+			break
+
+		remove_file(path)
+		total_size -= size
+
+def query_daemon(argv):
+	"""Asks the daemon serving the repository to run the command and prints
+	its output. Returns the exit status of the command, or None if there is
+	no daemon to ask or it does not start running the command within
+	daemon-timeout seconds."""
+
+	import socket
+
+	path = get_daemon_socket_path()
+
+	if not os.path.exists(path):
+		return None
+
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(float(options['daemon-timeout']))
+
+	try:
+		try:
+			client.connect(path)
+
+			client.sendall(json.dumps({
+				'args': argv,
+				'cwd': os.getcwd(),
+				'isatty': sys.stdout.isatty()
+			}))
+			client.shutdown(socket.SHUT_WR)
+
+			# The daemon acknowledges the command when it starts running it,
+			# after which it may take as long as it needs
+			if client.recv(1) != '\n':
+				return None
+
+			client.settimeout(None)
+			response = json.loads(read_socket(client))
+		except (socket.error, ValueError):
+			return None
+	finally:
+		client.close()
+
+	sys.stderr.write(response['stderr'].encode('utf-8'))
+	sys.stdout.write(response['stdout'].encode('utf-8'))
+
+	return response['status']
+
+def read_http_cache(url):
+	"""Returns the cached response for the url, or None if there is none"""
+
+	try:
+		f = open(get_http_cache_path(url), 'rb')
+		try:
+			entry = json.load(f)
+		finally:
+			f.close()
+	except (IOError, ValueError):
+		return None
+
+	if entry.get('url') != url:
+		return None
+
+	return entry
+
+def ref_exists(ref):
+	"""Returns whether the fully qualified ref exists"""
+
+	return get_object_info(ref) is not None
+
+def read_socket(connection):
+	"""Returns everything received on the socket until the other end stops
+	sending"""
+
+	chunks = []
+
+	while True:
+		chunk = connection.recv(65536)
+
+		if not chunk:
+			return ''.join(chunks)
+
+		chunks.append(chunk)
+
+def refresh_daemon(repo_name):
+	"""Refreshes the open pull requests stored for the repository every
+	daemon-refresh seconds, for as long as the daemon runs"""
+
+	while True:
+		# Commands are answered from the store meanwhile, so a slow github does
+		# not hold them up
+		try:
+			for pull_requests in get_github_pull_request_pages(repo_name):
+				pass
+		except UserWarning, e:
+			# Commands being answered capture sys.stdout
+			print >> sys.__stdout__, color_text(e, 'warning')
+
+		time.sleep(float(options['daemon-refresh']))
+
+def release_http_connection(scheme, host, conn):
+	"""Returns a connection to the pool of idle keep-alive connections"""
+
+	with http_connections_lock:
+		http_connections.setdefault((scheme, host), []).append(conn)
+
+def remove_file(path):
+	"""Removes the file if it exists"""
+
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+def run_command(command, cwd = None):
+	"""Runs a shell command with its output captured, optionally in another
+	directory, and returns its exit status and output"""
+
+	with timed(get_command_category(command), command, {'cwd': cwd}):
+		process = subprocess.Popen(command, shell = True, cwd = cwd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+		output = process.communicate()[0]
+
+	return process.returncode, output
+
+def run_jobs(function, items, jobs):
+	"""Calls the function on every item using a pool of worker threads, and
+	yields the results in the order of the items as soon as each one is
+	available. Exceptions raised by the function are raised again in the
+	caller when the result of that item is reached.
+
+	Items are taken from the iterable by a background thread only as workers
+	become free, so it can be a generator that is still producing them, such
+	as one reading pages from github."""
+
+	# A jobs setting of 0 or less would start no workers and wait forever
+	jobs = max(1, jobs)
+	queue = Queue.Queue(jobs)
+	results = {}
+	results_ready = threading.Condition()
+	feed_state = {'count': None, 'error': None}
+
+	def feed():
+		count = 0
+		error = None
+
+		try:
+			for item in items:
+				queue.put((count, item))
+				count += 1
+		except:
+			error = sys.exc_info()
+
+		for i in range(jobs):
+			queue.put(None)
+
+		with results_ready:
+			feed_state['count'] = count
+			feed_state['error'] = error
+			results_ready.notify_all()
+
+	def work():
+		while True:
+			job = queue.get()
+
+			if job is None:
+				return
+
+			index, item = job
+
+			try:
+				result = (True, function(item))
+			except:
+				result = (False, sys.exc_info())
+
+			with results_ready:
+				results[index] = result
+				results_ready.notify_all()
+
+	for target in [feed] + [work] * jobs:
+		thread = threading.Thread(target = target)
+		thread.daemon = True
+		thread.start()
+
+	index = 0
+
+	while True:
+		with results_ready:
+			while index not in results and (feed_state['count'] is None or index < feed_state['count']):
+				# Waiting with a timeout keeps the main thread responsive to
+				# KeyboardInterrupt
+				results_ready.wait(0.1)
+
+			if index not in results:
+				break
+
+			success, value = results.pop(index)
+
+		if not success:
+			raise value[0], value[1], value[2]
+
+		yield value
+		index += 1
+
+	error = feed_state['error']
+
+	if error is not None:
+		raise error[0], error[1], error[2]
+
+def run_watch_action(repo_name, action, state, pull_request, current_branch_name):
+	"""Runs the watch action on the fetched branch of the pull request"""
+
+	branch_name = build_branch_name(pull_request)
+
+	if action == 'stat':
+		branch_name, merge_base, diff_stats = get_pull_request_stats(pull_request)
+		display_diff_stats(pull_request, branch_name, merge_base, diff_stats)
+		return
+
+	if action == 'update' and branch_name == current_branch_name:
+		print color_text("Skipping the update of %s, which is checked out" % branch_name, 'warning')
+	elif action == 'update':
+		if state['worktree'] is None:
+			state['worktree'] = add_update_worktree()
+
+		conflicts = update_branch_in_worktree(repo_name, branch_name, state['worktree'])
+
+		if conflicts is None:
+			print color_text("Updated %s from master" % branch_name, 'success')
+		else:
+			worktree_path, conflicting_files = conflicts
+			print color_text("Conflicts updating %s in %s, resolve them and run 'gitpr continue-update'" % (branch_name, worktree_path), 'warning')
+
+			for path in conflicting_files:
+				print "	%s" % path
+
+			# Leave the worktree to the conflicts
+			state['worktree'] = None
+
+def save_fetch(repo_name, pull_request):
+	"""Records that the pull request was just fetched into its local branch,
+	which also forgets the commits of any previous update"""
+
+	save_pull_requests(repo_name, [pull_request])
+
+	with store_lock:
+		with get_store():
+			get_store().execute(
+				"UPDATE pull_requests SET fetched_at = ?, original_commits = NULL WHERE repo_name = ? AND number = ?",
+				(time.time(), repo_name, pull_request['number']))
+
+def save_memo(kind, base_sha, head_sha, value):
+	"""Remembers the result of a computation on two commit SHAs, forgetting
+	the least recently used results once there are too many"""
+
+	with store_lock:
+		with get_store():
+			get_store().execute(
+				"INSERT OR REPLACE INTO memos (kind, base_sha, head_sha, value, used_at) VALUES (?, ?, ?, ?, ?)",
+				(kind, base_sha, head_sha, json.dumps(value), time.time()))
+
+			get_store().execute(
+				"DELETE FROM memos WHERE rowid IN (SELECT rowid FROM memos ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+				(int(options['memo-max-entries']),))
+
+def save_original_commits(repo_name, pull_request_ID, branch_treeish):
+	"""Records the range of commits the pull request branch had before being
+	updated from master"""
+
+	with store_lock:
+		with get_store():
+			cursor = get_store().execute(
+				"UPDATE pull_requests SET original_commits = ? WHERE repo_name = ? AND number = ?",
+				(branch_treeish, repo_name, int(pull_request_ID)))
+
+			if cursor.rowcount == 0:
+				# The pull request has never been stored, so add a placeholder
+				# that is stale and will be refreshed when next looked up
+				get_store().execute(
+					"INSERT INTO pull_requests (repo_name, number, state, refreshed_at, original_commits) VALUES (?, ?, 'open', 0, ?)",
+					(repo_name, int(pull_request_ID), branch_treeish))
+
+def save_pull_request_state(repo_name, pull_request_ID, state):
+	"""Records a change in the state of the pull request"""
+
+	with store_lock:
+		with get_store():
+			get_store().execute(
+				"UPDATE pull_requests SET state = ? WHERE repo_name = ? AND number = ?",
+				(state, repo_name, int(pull_request_ID)))
+
+def save_pull_request_list(repo_name, listed_at):
+	"""Records that all the open pull requests were stored by a listing that
+	started at listed_at, so any other pull request stored as open has been
+	closed since"""
+
+	with store_lock:
+		with get_store():
+			get_store().execute(
+				"UPDATE pull_requests SET state = 'closed' WHERE repo_name = ? AND state = 'open' AND refreshed_at < ?",
+				(repo_name, listed_at))
+
+			get_store().execute(
+				"INSERT OR REPLACE INTO pull_request_lists (repo_name, refreshed_at) VALUES (?, ?)",
+				(repo_name, listed_at))
+
+def save_search_paths(repo_name, paths_by_number):
+	"""Stores the paths changed by pull requests for searches, along with the
+	head commit they were found for"""
+
+	with store_lock:
+		with get_store():
+			for number, (head_sha, paths) in paths_by_number.items():
+				get_store().execute(
+					"DELETE FROM search_terms WHERE repo_name = ? AND number = ? AND kind = 'path'",
+					(repo_name, number))
+
+				get_store().executemany(
+					"INSERT OR IGNORE INTO search_terms (repo_name, kind, term, number) VALUES (?, 'path', ?, ?)",
+					[(repo_name, path, number) for path in paths])
+
+				get_store().execute(
+					"INSERT OR REPLACE INTO search_paths (repo_name, number, head_sha) VALUES (?, ?, ?)",
+					(repo_name, number, head_sha))
+
+def save_search_terms(repo_name, pull_request):
+	"""Indexes a pull request for searches, replacing what it was indexed
+	under before apart from the paths it changes. This is done as part of the
+	store transaction of the caller, which must hold the store lock."""
+
+	get_store().execute(
+		"DELETE FROM search_terms WHERE repo_name = ? AND number = ? AND kind != 'path'",
+		(repo_name, pull_request['number']))
+
+	get_store().executemany(
+		"INSERT INTO search_terms (repo_name, kind, term, number) VALUES (?, ?, ?, ?)",
+		[(repo_name, kind, term, pull_request['number']) for kind, term in get_search_terms(pull_request)])
+
+def save_pull_requests(repo_name, pull_requests):
+	"""Stores pull requests retrieved from github"""
+
+	now = time.time()
+
+	with store_lock:
+		with get_store():
+			for pull_request in pull_requests:
+				values = (
+					pull_request.get('state') or 'open',
+					json.dumps(pull_request),
+					pull_request['head'].get('sha'),
+					now,
+					repo_name,
+					pull_request['number'])
+
+				cursor = get_store().execute(
+					"UPDATE pull_requests SET state = ?, data = ?, head_sha = ?, refreshed_at = ? WHERE repo_name = ? AND number = ?",
+					values)
+
+				if cursor.rowcount == 0:
+					get_store().execute(
+						"INSERT INTO pull_requests (state, data, head_sha, refreshed_at, repo_name, number) VALUES (?, ?, ?, ?, ?, ?)",
+						values)
+
+				save_search_terms(repo_name, pull_request)
+
+def search_pull_requests(repo_name, terms):
+	"""Returns the open pull requests matching every search term, newest first,
+	using the index in the local store"""
+
+	query = parse_search_query(terms)
+
+	if get_stored_pull_request_pages(repo_name) is None:
+		# Build the index the first time
+		if options['offline']:
+			raise UserWarning("The open pull requests for %s are not stored locally, run without --offline to retrieve them" % repo_name)
+
+		for pull_requests in get_github_pull_request_pages(repo_name):
+			pass
+
+	update_search_index(repo_name, any(kind == 'path' for kind, term in query))
+
+	conditions = []
+	values = [repo_name]
+
+	for kind, term in query:
+		if kind == 'text':
+			conditions.append("SELECT number FROM search_terms WHERE repo_name = ? AND kind IN ('author', 'word') AND term >= ? AND term < ?")
+			values.extend([repo_name, term, term + u'\uffff'])
+		elif kind == 'path':
+			conditions.append("SELECT number FROM search_terms WHERE repo_name = ? AND kind = ? AND term >= ? AND term < ?")
+			values.extend([repo_name, kind, term, term + u'\uffff'])
+		else:
+			conditions.append("SELECT number FROM search_terms WHERE repo_name = ? AND kind = ? AND term = ?")
+			values.extend([repo_name, kind, term])
+
+	with store_lock:
+		rows = get_store().execute(
+			"SELECT data FROM pull_requests WHERE repo_name = ? AND state = 'open' AND data IS NOT NULL AND number IN (%s) ORDER BY number DESC" % " INTERSECT ".join(conditions),
+			values).fetchall()
+
+	return [json.loads(row['data']) for row in rows]
+
+def serve_daemon_request(connection):
+	"""Runs a command sent to the daemon as if it was run in the directory of
+	the client, and sends back its output and exit status"""
+
+	global data_output, data_records
+
+	data = read_socket(connection)
+
+	if not data:
+		# Another daemon starting up, checking whether this one is running
+		return
+
+	request = json.loads(data)
+
+	# Let the client know the command is running, so it waits for the answer
+	connection.sendall('\n')
+
+	# Facts about what is checked out may have changed since the last command
+	with git_facts_lock:
+		for key in git_facts.keys():
+			if key[1] in ('current-branch', 'remotes'):
+				del git_facts[key]
+
+	with timings_lock:
+		del timings[:]
+
+	stdout = build_output_capture(request['isatty'])
+	stderr = build_output_capture(False)
+
+	saved_options = dict(options)
+	saved_state = (os.getcwd(), sys.argv, sys.stdout, sys.stderr, data_output)
+	status = 0
+
+	try:
+		os.chdir(request['cwd'])
+
+		sys.argv = ['gitpr'] + request['args']
+		sys.stdout = stdout
+		sys.stderr = stderr
+		data_output = stdout
+		data_records = 0
+
+		try:
+			main()
+		except UserWarning, e:
+			print color_text(e, 'error')
+			status = 1
+		except SystemExit, e:
+			status = e.code or 0
+	finally:
+		# Restore the options without removing them first, since the refresh
+		# thread reads them meanwhile
+		for key in set(options) - set(saved_options):
+			del options[key]
+
+		options.update(saved_options)
+
+		cwd, sys.argv, sys.stdout, sys.stderr, data_output = saved_state
+		os.chdir(cwd)
+
+	connection.sendall(json.dumps({
+		'status': status,
+		'stdout': stdout.getvalue().decode('utf-8', 'replace'),
+		'stderr': stderr.getvalue().decode('utf-8', 'replace')
+	}))
+
+def scheduled_request(method, url, body, headers):
+	"""Performs an HTTP request to github, waiting as needed to stay within
+	the API rate limit, and retrying temporary failures with jittered
+	exponential backoff. Returns the same as http_request.
+
+	Only GET requests are retried after server errors and connection
+	failures, since github may already have acted on other requests.
+	Requests rejected by the rate limit are always retried."""
+
+	import httplib
+	import socket
+
+	retries = int(options['http-retries'])
+	delay = float(options['http-retry-delay'])
+
+	for attempt in range(retries + 1):
+		wait_for_rate_limit()
+
+		try:
+			with timed('http', '%s %s' % (method, url)) as timing:
+				status, reason, response_headers, data = http_request(method, url, body, headers)
+
+				timing['status'] = status
+				timing['bytes'] = len(data)
+		except (httplib.HTTPException, socket.error), e:
+			if method != 'GET' or attempt == retries:
+				raise UserWarning("Error communicating with github: %s\n%s" % (url, e))
+
+			wait = delay * 2 ** attempt * random.uniform(0.5, 1.5)
+		else:
+			update_rate_limit(response_headers)
+
+			rate_limited = status == 429 or (status == 403 and response_headers.getheader('x-ratelimit-remaining') == '0')
+
+			if not (rate_limited or (method == 'GET' and status in (500, 502, 503, 504))) or attempt == retries:
+				return status, reason, response_headers, data
+
+			wait = delay * 2 ** attempt * random.uniform(0.5, 1.5)
+
+			retry_after = response_headers.getheader('retry-after')
+
+			if retry_after is not None and retry_after.isdigit():
+				wait = max(wait, float(retry_after))
+			elif rate_limited and rate_limit['reset'] is not None:
+				wait = max(wait, rate_limit['reset'] - time.time())
+
+		with http_connections_lock:
+			http_stats['retried'] += 1
+
+		time.sleep(max(wait, 0))
+
+def split_pull_request_IDs(args):
+	"""Returns the pull request IDs at the start of the command arguments,
+	along with the comment following them if there is one"""
+
+	pull_request_IDs = []
+
+	for arg in args:
+		if not arg.isdigit():
+			return pull_request_IDs, arg
+
+		pull_request_IDs.append(int(arg))
+
+	return pull_request_IDs, None
+
+def system(command):
+	"""Runs a shell command that may change the current branch, and returns its
+	exit status"""
+
+	with timed(get_command_category(command), command):
+		ret = os.system(command)
+
+	with git_facts_lock:
+		for key in git_facts.keys():
+			if key[1] == 'current-branch':
+				del git_facts[key]
+
+	return ret
+
+@contextlib.contextmanager
+def timed(category, name, args = None):
+	"""Records how long the body of the with statement takes. The dictionary
+	of details recorded with the timing is given to the body, so it can add the
+	results of the work."""
+
+	if args is None:
+		args = {}
+
+	start = time.time()
+
+	try:
+		yield args
+	finally:
+		event = {
+			'name': name,
+			'cat': category,
+			'start': start,
+			'dur': time.time() - start,
+			'tid': threading.current_thread().ident,
+			'args': args
+		}
+
+		with timings_lock:
+			timings.append(event)
+
+def touch_http_cache(url):
+	"""Marks the cached response for the url as recently used"""
+
+	try:
+		os.utime(get_http_cache_path(url), None)
+	except OSError:
+		pass
+
+def update_rate_limit(response_headers):
+	"""Records the rate limit reported in the headers of a github response"""
+
+	remaining = response_headers.getheader('x-ratelimit-remaining')
+	reset = response_headers.getheader('x-ratelimit-reset')
+
+	if remaining is None or not remaining.isdigit():
+		return
+
+	with http_connections_lock:
+		rate_limit['remaining'] = int(remaining)
+
+		if reset is not None and reset.isdigit():
+			rate_limit['reset'] = float(reset)
+
+def update_search_index(repo_name, paths = False):
+	"""Indexes the stored open pull requests that are not indexed yet, and
+	optionally the paths changed by the pull request branches that moved since
+	they were last indexed"""
+
+	with store_lock:
+		rows = get_store().execute(
+			"SELECT data FROM pull_requests WHERE repo_name = ? AND state = 'open' AND data IS NOT NULL AND number NOT IN (SELECT number FROM search_terms WHERE repo_name = ? AND kind = 'author')",
+			(repo_name, repo_name)).fetchall()
+
+	if rows:
+		with store_lock:
+			with get_store():
+				for row in rows:
+					save_search_terms(repo_name, json.loads(row['data']))
+
+	if not paths:
+		return
+
+	with store_lock:
+		indexed_heads = dict(get_store().execute(
+			"SELECT number, head_sha FROM search_paths WHERE repo_name = ?",
+			(repo_name,)).fetchall())
+
+	master_sha = get_commit_shas('master')[0]
+	moved_branches = []
+
+	for branch_name, head_sha in get_pull_request_branch_heads().items():
+		if indexed_heads.get(get_pull_request_ID(branch_name)) != head_sha:
+			moved_branches.append((get_pull_request_ID(branch_name), head_sha))
+
+	def find_paths(branch):
+		number, head_sha = branch
+
+		try:
+			merge_base = get_merge_base(master_sha, head_sha)
+			return number, head_sha, get_changed_paths(merge_base, head_sha)
+		except UserWarning:
+			return number, head_sha, []
+
+	jobs = options['stat-jobs'] or get_cpu_count()
+	paths_by_number = {}
+
+	for number, head_sha, changed_paths in run_jobs(find_paths, moved_branches, int(jobs)):
+		paths_by_number[number] = (head_sha, changed_paths)
+
+	save_search_paths(repo_name, paths_by_number)
+
+def update_branch(repo_name, branch_name):
+	if in_work_dir() or in_update_worktree():
 		raise UserWarning("Cannot perform an update from within the work directory.\nIf you are done fixing conflicts run 'gitpr continue-update' to complete the update.")
 
 	if options['work-dir']:
 		print color_text("Switching to work directory", 'status')
 		os.chdir(options['work-dir'])
-		ret = os.system('git reset --hard && git clean -f')
+		ret = system('git reset --hard && git clean -f')
 		if ret != 0:
 			raise UserWarning("Cleaning up work directory failed, update not performed")
 
-	ret = os.system('git checkout %s' % branch_name)
+	fetch_missing_objects(repo_name, branch_name)
+
+	ret = system('git checkout %s' % branch_name)
 	if ret != 0:
 		if options['work-dir']:
 			raise UserWarning("Could not checkout %s in the work directory, update not performed" % branch_name)
 		else:
 			raise UserWarning("Could not checkout %s, update not performed" % branch_name)
 
-	parent_commit = os.popen('git merge-base master %s' % branch_name).read().strip()
-	head_commit = os.popen('git rev-parse HEAD').read().strip()
+	master_commit, head_commit = get_commit_shas('master', 'HEAD')
+	parent_commit = get_merge_base(master_commit, head_commit)
 
 	if parent_commit == head_commit:
 		branch_treeish = head_commit[0:10]
@@ -895,16 +3575,14 @@ def update_branch(branch_name):
 		branch_treeish = '%s..%s' % (parent_commit[0:10], head_commit[0:10])
 
 	pull_request_ID = get_pull_request_ID(branch_name)
-	f = open('/tmp/git-pull-request-treeish-%s' % pull_request_ID, 'wb')
-	f.write(branch_treeish)
-	f.close()
+	save_original_commits(repo_name, pull_request_ID, branch_treeish)
 
 	print color_text("Original commits: %s" % branch_treeish, 'status')
 
 	if options['update-method'] == 'merge':
-		ret = os.system('git merge master')
+		ret = system('git merge master')
 	elif options['update-method'] == 'rebase':
-		ret = os.system('git rebase master')
+		ret = system('git rebase master')
 
 	if ret != 0:
 		if options['work-dir']:
@@ -913,9 +3591,229 @@ def update_branch(branch_name):
 
 	complete_update(branch_name)
 
+def update_branch_in_worktree(repo_name, branch_name, worktree_path):
+	"""Updates a branch from master in a worktree of the update-all pool, and
+	returns None if the update completed, or the worktree path and the
+	conflicting files if the branch was left in the worktree with conflicts"""
+
+	fetch_missing_objects(repo_name, branch_name)
+
+	ret, output = run_command('git reset -q --hard && git clean -fdq && git checkout -q %s' % branch_name, worktree_path)
+	if ret != 0:
+		raise UserWarning("Could not checkout %s in %s, update not performed\n%s" % (branch_name, worktree_path, output))
+
+	master_commit, head_commit = get_commit_shas('master', branch_name)
+	parent_commit = get_merge_base(master_commit, head_commit)
+
+	if parent_commit == head_commit:
+		branch_treeish = head_commit[0:10]
+	else:
+		branch_treeish = '%s..%s' % (parent_commit[0:10], head_commit[0:10])
+
+	save_original_commits(repo_name, get_pull_request_ID(branch_name), branch_treeish)
+
+	if options['update-method'] == 'merge':
+		ret, output = run_command('git merge --no-edit master', worktree_path)
+	elif options['update-method'] == 'rebase':
+		ret, output = run_command('git rebase master', worktree_path)
+
+	if ret != 0:
+		ret, conflicting_files = run_command('git diff --name-only --diff-filter=U', worktree_path)
+		return worktree_path, conflicting_files.splitlines()
+
+	ret, output = run_command('git checkout -q --detach', worktree_path)
+	if ret != 0:
+		raise UserWarning("Could not release %s from %s\n%s" % (branch_name, worktree_path, output))
+
+	return None
+
+def wait_for_rate_limit():
+	"""Waits before a github request when few requests remain before the rate
+	limit resets, spreading the remaining ones out evenly, or waiting for the
+	reset when none remain"""
+
+	with http_connections_lock:
+		remaining = rate_limit['remaining']
+		reset = rate_limit['reset']
+
+		if remaining is None or reset is None or remaining >= int(options['rate-limit-reserve']):
+			return
+
+		wait = reset - time.time()
+
+		if wait <= 0:
+			return
+
+		if remaining > 0:
+			wait /= remaining
+
+		# Count this request against the budget so concurrent requests are
+		# spread out too
+		rate_limit['remaining'] = max(remaining - 1, 0)
+		http_stats['throttled'] += 1
+
+	time.sleep(wait)
+
+def watch_pull_requests(repo_name, action, state):
+	"""Lists the open pull requests, reports the ones opened, moved or closed
+	since the previous snapshot kept in the state, and fetches the changed
+	ones, running the watch action on each fetched branch
+
+	The first snapshot fetches every pull request whose local branch is
+	missing or not at its head. Pull requests whose fetch or action failed
+	are tried again by the next poll."""
+
+	pull_requests = {}
+
+	for page in get_github_pull_request_pages(repo_name):
+		for pull_request in page:
+			pull_requests[pull_request['number']] = pull_request
+
+	snapshot = dict((number, pull_request['head'].get('sha')) for number, pull_request in pull_requests.items())
+	previous = state['snapshot']
+
+	if previous is None:
+		changed = sorted(snapshot)
+	else:
+		opened = sorted(number for number in snapshot if number not in previous)
+		moved = sorted(number for number in snapshot if number in previous and snapshot[number] != previous[number])
+		closed = sorted(number for number in previous if number not in snapshot)
+
+		if opened or moved or closed:
+			print color_text("%s: %s opened, %s updated, %s closed" % (time.strftime('%H:%M:%S'), len(opened), len(moved), len(closed)), 'status')
+
+			for number in closed:
+				print "REQUEST %s closed" % number
+
+			print
+
+		changed = opened + moved
+
+	# Retry the pull requests that failed before and are still open
+	retried = set(number for number in state['failed'] if number in snapshot and number not in changed)
+	changed = sorted(set(changed) | retried)
+
+	state['snapshot'] = snapshot
+	state['failed'] = set()
+
+	if not changed:
+		return
+
+	current_branch_name = get_current_branch_name(False)
+
+	for pull_request, output, error, up_to_date in fetch_pull_requests(repo_name, [[pull_requests[number] for number in changed]]):
+		# A retried pull request may have been fetched before its action failed
+		if up_to_date and pull_request['number'] not in retried:
+			continue
+
+		display_pull_request_minimal(pull_request)
+
+		if output and not up_to_date:
+			print output.rstrip()
+
+		if error is None:
+			try:
+				run_watch_action(repo_name, action, state, pull_request, current_branch_name)
+			except UserWarning, e:
+				error = e
+
+		if error is not None:
+			state['failed'].add(pull_request['number'])
+			print color_text(error, 'error')
+
+		print
+
+def write_trace_file(path):
+	"""Saves the timings in the Chrome trace event format, which can be
+	loaded in chrome://tracing or Perfetto"""
+
+	with timings_lock:
+		events = list(timings)
+
+	pid = os.getpid()
+	trace_events = []
+
+	for event in events:
+		trace_events.append({
+			'name': event['name'],
+			'cat': event['cat'],
+			'ph': 'X',
+			'ts': int(event['start'] * 1000000),
+			'dur': int(event['dur'] * 1000000),
+			'pid': pid,
+			'tid': event['tid'],
+			'args': event['args']
+		})
+
+	try:
+		f = open(os.path.expanduser(path), 'wb')
+		try:
+			json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+		finally:
+			f.close()
+	except IOError, e:
+		raise UserWarning("Could not write the trace file %s\n%s" % (path, e))
+
+def write_http_cache(url, response_headers, data):
+	"""Caches a response that can be revalidated with a conditional request"""
+
+	global http_cache_pruned
+
+	etag = response_headers.getheader('etag')
+	last_modified = response_headers.getheader('last-modified')
+
+	if etag is None and last_modified is None:
+		return
+
+	path = get_http_cache_path(url)
+	entry = {
+		'url': url,
+		'etag': etag,
+		'last-modified': last_modified,
+		'link': response_headers.getheader('link'),
+		'body': data
+	}
+
+	try:
+		# Responses about private repositories are cached, so keep them
+		# readable by the user alone
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path), 0700)
+
+		# Write to a temporary file first so concurrent runs never read a
+		# partially written response
+		temp_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+		f = os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+		try:
+			json.dump(entry, f)
+		finally:
+			f.close()
+
+		os.rename(temp_path, path)
+
+		if not http_cache_pruned:
+			http_cache_pruned = True
+			prune_http_cache()
+	except (IOError, OSError):
+		pass
+
 if __name__ == "__main__":
 	try:
-		main()
+		try:
+			with timed('command', ' '.join(['gitpr'] + sys.argv[1:])):
+				main()
+		finally:
+			close_http_connections()
+			close_git_object_lookups()
+
+			if options['http-stats']:
+				display_http_stats()
+
+			if options['timings']:
+				display_timings()
+
+			if options['trace-file']:
+				write_trace_file(options['trace-file'])
 	except UserWarning, e:
 		print color_text(e, 'error')
 		sys.exit(1)